@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+'''
+benchmark (c) University of Manchester 2019
+
+benchmark is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Timing of the Design-Build-Test-Learn stages
+'''
+
+import os, sys, time, json, argparse, subprocess
+import numpy as np
+from itertools import product
+import pathSim
+
+
+def localDoe(steps, variants, npromoters, nplasmids, libsize, positional, random=False, seed=0):
+    """ Deterministic offline stand-in for evaldes: a balanced random design
+        with the same factor layout as the optimal DoE.
+        Levels: plasmids 0.., first promoter 1.., variants 0..,
+        other promoters 1..2*npromoters (upper half are empty positions).
+    """
+    rng = np.random.RandomState(seed)
+    factors = []
+    if nplasmids > 1:
+        factors.append( np.arange(nplasmids) )
+    if npromoters > 1:
+        factors.append( np.arange(1, npromoters+1) )
+    for i in np.arange(steps):
+        if variants > 1:
+            factors.append( np.arange(variants) )
+        if npromoters > 1 and i < steps-1:
+            factors.append( np.arange(1, 2*npromoters+1) )
+    if len(factors) == 0:
+        raise Exception("No solution")
+    M = np.zeros( (libsize, len(factors)), dtype=int )
+    for j, lev in enumerate(factors):
+        col = np.tile( lev, int(np.ceil(libsize/len(lev))) )[0:libsize]
+        M[:,j] = rng.permutation(col)
+    # D-efficiency of the one-hot coded design (100 = orthogonal)
+    X = [ np.ones( (libsize,1) ) ]
+    for j, lev in enumerate(factors):
+        X.append( (M[:,j].reshape(-1,1) == lev[1:].reshape(1,-1)).astype(float) )
+    X = np.hstack(X)
+    sign, logdet = np.linalg.slogdet( np.dot(X.T, X)/libsize )
+    J = 100*np.exp( logdet/X.shape[1] ) if sign > 0 else 0.0
+    diagnostics = { 'M': M, 'J': J, 'pow': [np.nan], 'rpv': [np.nan],
+                    'factors': [list(x) for x in factors], 'seed': seed,
+                    'steps': steps, 'variants': variants, 'npromoters': npromoters,
+                    'nplasmids': nplasmids, 'libsize': libsize }
+    return diagnostics
+
+
+def timeit(fn, repeat=3):
+    """ Best wall time of fn() and its last result """
+    best = np.inf
+    res = None
+    for r in np.arange(repeat):
+        t0 = time.perf_counter()
+        res = fn()
+        best = min( best, time.perf_counter()-t0 )
+    return best, res
+
+def benchConfig(steps, variants, npromoters, nplasmids, libsize, repeat=3, seed=0,
+                predSample=1000, simSample=20, maxfull=1e6, timespan=3600):
+    """ Time every stage for one configuration """
+    np.random.seed(seed)
+    config = { 'steps': steps, 'variants': variants, 'npromoters': npromoters,
+               'nplasmids': nplasmids, 'libsize': libsize }
+    times = {}
+    par = pathSim.Parameters(nplasmids, npromoters, steps, variants)
+    diagnostics = localDoe(steps, variants, npromoters, nplasmids, libsize, False, seed=seed)
+    M = diagnostics['M']
+    design = pathSim.Assembly( M[0,:], steps, nplasmids, npromoters, variants )
+    promoters = pathSim.Promoters(par, design)
+    times['pathway'], pw = timeit( lambda: pathSim.pathway(promoters, store=None), repeat )
+    pathSim.pathway(promoters, private=False)
+    times['Construct'], pw = timeit( lambda: pathSim.Construct(par, design, private=False), repeat )
+    times['simulate'], y = timeit( lambda: pathSim.Endpoint(pathSim.Construct(par, design, private=False), timespan), repeat )
+    designs = [ pathSim.Assembly( M[i,:], steps, nplasmids, npromoters, variants ) for i in np.arange(M.shape[0]) ]
+    t, results = timeit( lambda: pathSim.runDesigns(par, designs, timespan=timespan), 1 )
+    times['build'] = t
+    times['build_ensemble'], r = timeit( lambda: pathSim.runDesigns(par, designs, timespan=timespan,
+                                                                    backend='ensemble'), 1 )
+    times['FitModel'], (res, dd) = timeit( lambda: pathSim.FitModel(M, results), repeat )
+    times['FitModel_fast'], r = timeit( lambda: pathSim.FitModel(M, results, fast=True), repeat )
+    times['BestCombinations_random'], ndata = timeit( lambda: pathSim.BestCombinations(res, dd, random=predSample), repeat )
+    space = np.prod( [float(len(dd.iloc[:,j].unique())) for j in np.arange(dd.shape[1]-1)] )
+    if space <= maxfull:
+        times['BestCombinations_full'], r = timeit( lambda: pathSim.BestCombinations(res, dd, random=None, top=100), 1 )
+    times['ValidatePred'], r = timeit( lambda: pathSim.ValidatePred(ndata.copy(), par, steps, nplasmids, npromoters,
+                                                                     variants, random=simSample, timespan=timespan), 1 )
+    return [ dict(config, stage=k, seconds=v) for k, v in times.items() ]
+
+def workerStart(x):
+    return os.getpid()
+
+def coldStart(repeat=3):
+    """ Process startup cost: importing pathSim in a fresh interpreter
+        (default and headless) and spawning a pool worker that imports it
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    config = { 'steps': 0, 'variants': 0, 'npromoters': 0, 'nplasmids': 0, 'libsize': 0 }
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = 'import pathSim; pathSim.pathway([1, None], store=None)'
+    times = {}
+    for stage, headless in (('import', False), ('import_headless', True)):
+        env = dict(os.environ)
+        env.pop('PATHSIM_HEADLESS', None)
+        if headless:
+            env['PATHSIM_HEADLESS'] = '1'
+        times[stage], r = timeit( lambda: subprocess.run( [sys.executable, '-c', code], cwd=here,
+                                                          env=env, check=True ), repeat )
+    def spawn():
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            return pool.submit(workerStart, 0).result()
+    times['worker_start'], r = timeit( spawn, repeat )
+    return [ dict(config, stage=k, seconds=v) for k, v in times.items() ]
+
+def grid(quick=False):
+    if quick:
+        return product( [4, 8], [1, 5], [1, 3], [2], [32] )
+    return product( [4, 8, 16, 30], [1, 5, 10], [1, 3, 5], [2], [32, 128, 256] )
+
+def runBenchmark(quick=False, repeat=3, outfile=None):
+    records = coldStart(repeat)
+    for steps, variants, npromoters, nplasmids, libsize in grid(quick):
+        libsize = max( libsize, pathSim.minLibrary(steps, variants, npromoters, nplasmids) )
+        print( "Steps=%d Variants=%d Promoters=%d Plasmids=%d Size=%d" % (steps, variants, npromoters, nplasmids, libsize) )
+        records.extend( benchConfig(steps, variants, npromoters, nplasmids, libsize, repeat) )
+    if outfile is not None:
+        with open(outfile, 'w') as h:
+            json.dump( records, h, indent=1 )
+    return records
+
+def recordKey(r):
+    return (r['steps'], r['variants'], r['npromoters'], r['nplasmids'], r['libsize'], r['stage'])
+
+def compare(records, baseline, tolerance=0.25, floor=1e-3):
+    """ Stages slower than the baseline by more than tolerance (relative);
+        timings below floor seconds are ignored as noise.
+    """
+    base = { recordKey(r): r['seconds'] for r in baseline }
+    slower = []
+    for r in records:
+        k = recordKey(r)
+        if k not in base or max(r['seconds'], base[k]) < floor:
+            continue
+        ratio = r['seconds']/base[k]
+        if ratio > 1 + tolerance:
+            slower.append( dict(r, baseline=base[k], ratio=ratio) )
+            print( "Slower: %s %.4fs vs %.4fs (x%.2f)" % (k, r['seconds'], base[k], ratio) )
+    return slower
+
+def arguments():
+    parser = argparse.ArgumentParser(description='Benchmark of the pathSim DBTL stages')
+    parser.add_argument('-out', default='benchmark.json',
+                        help='Output file (JSON)')
+    parser.add_argument('-baseline', default=None,
+                        help='Baseline file to compare with')
+    parser.add_argument('-tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='Repetitions per stage (best time is kept)')
+    parser.add_argument('-quick', action='store_true',
+                        help='Small grid')
+    return parser
+
+if __name__ == '__main__':
+    arg = arguments().parse_args()
+    records = runBenchmark( arg.quick, arg.repeat, arg.out )
+    if arg.baseline is not None and os.path.exists(arg.baseline):
+        with open(arg.baseline) as h:
+            baseline = json.load(h)
+        if len( compare(records, baseline, arg.tolerance) ) > 0:
+            raise SystemExit(1)
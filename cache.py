@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+'''
+cache (c) University of Manchester 2019
+
+cache is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Caches for compiled pathway models and simulation results
+'''
+
+import os, hashlib, tempfile, shutil, json
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from instrument import count
+
+# Headless batch mode: models are loaded with antimony and libroadrunner
+# only, without the tellurium import (and its plotting stack)
+HEADLESS = os.getenv('PATHSIM_HEADLESS') is not None
+
+
+def loadAntimony(antinom):
+    """ Compile an Antimony model, as te.loada """
+    if not HEADLESS:
+        import tellurium as te
+        return te.loada(antinom)
+    import antimony, roadrunner
+    antimony.clearPreviousLoads()
+    if antimony.loadAntimonyString(antinom) < 0:
+        raise Exception( antimony.getLastError() )
+    return roadrunner.RoadRunner( antimony.getSBMLString( antimony.getMainModuleName() ) )
+
+def setHeadless(flag=True):
+    """ Switch the headless mode, also for worker processes started later """
+    global HEADLESS
+    HEADLESS = flag
+    if flag:
+        os.environ['PATHSIM_HEADLESS'] = '1'
+    else:
+        os.environ.pop('PATHSIM_HEADLESS', None)
+
+def emptyRunner():
+    if not HEADLESS:
+        import tellurium as te
+        return te.roadrunner.ExtendedRoadRunner()
+    import roadrunner
+    return roadrunner.RoadRunner()
+
+
+class LRUCache():
+    """ Bounded in-memory cache, least recently used entries are dropped first """
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = OrderedDict()
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+    def clear(self):
+        self.entries.clear()
+    def __contains__(self, key):
+        return key in self.entries
+    def __len__(self):
+        return len(self.entries)
+
+
+def antimonyKey(antinom):
+    """ Content key of an Antimony model """
+    return hashlib.sha1(antinom.encode('utf-8')).hexdigest()
+
+
+class ModelStore():
+    """ Store of compiled RoadRunner models keyed by their Antimony text.
+        - Memory tier: LRU of loaded models, reset on every hit.
+        - Disk tier (optional): pristine serialized states that
+          any process can load without recompiling.
+        A model from load() is a private copy by default. Hot paths that
+        only simulate it once ask for the shared model (private=False): the
+        next load of the same model resets and returns the same object, so
+        it is only valid until then.
+    """
+    def __init__(self, size=64, path=None):
+        self.memory = LRUCache(size)
+        self.path = path
+        self.stats = {'compiles': 0, 'hits': 0, 'disk': 0}
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+
+    def statePath(self, key):
+        """ Saved states are only valid for the libroadrunner that wrote them """
+        import roadrunner
+        return os.path.join(self.path, '%s-%s.rr' % (key, roadrunner.__version__))
+
+    def load(self, antinom, private=True):
+        """ Return a model in the same state as te.loada(antinom),
+            shared with later loads unless private
+        """
+        key = antimonyKey(antinom)
+        entry = self.memory.get(key)
+        if entry is not None:
+            rr, selections = entry
+            rr.resetToOrigin()
+            rr.timeCourseSelections = selections
+            rr.steadyStateSelections = selections
+            self.stats['hits'] += 1
+            count('store_hits')
+            if private:
+                return self.copy(rr)
+            return rr
+        rr = None
+        if self.path is not None and os.path.exists(self.statePath(key)):
+            try:
+                rr = emptyRunner()
+                rr.loadState(self.statePath(key))
+                self.stats['disk'] += 1
+                count('store_disk')
+            except Exception:
+                rr = None
+        if rr is None:
+            rr = loadAntimony(antinom)
+            self.stats['compiles'] += 1
+            count('compiles')
+            if self.path is not None:
+                self.save(rr, key)
+        self.memory.put(key, (rr, list(rr.timeCourseSelections)))
+        if private:
+            return self.copy(rr)
+        return rr
+
+    def copy(self, rr):
+        """ Independent model with the state of rr (no recompilation) """
+        selections = list(rr.timeCourseSelections)
+        other = emptyRunner()
+        other.loadStateS( rr.saveStateS() )
+        other.timeCourseSelections = selections
+        other.steadyStateSelections = selections
+        return other
+
+    def save(self, rr, key):
+        """ Atomic write, concurrent jobs may be saving the same model """
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            rr.saveState(tmp)
+            os.replace(tmp, self.statePath(key))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def clear(self, disk=False):
+        self.memory.clear()
+        if disk and self.path is not None:
+            for f in os.listdir(self.path):
+                if f.endswith('.rr'):
+                    os.remove(os.path.join(self.path, f))
+
+
+class SimCache():
+    """ Memoization of design simulations by content key.
+        - Memory tier: LRU of endpoint values.
+        - Disk tier (optional): one small file per key. The directory
+          records the model version it was filled with and is emptied
+          if opened with a different one.
+    """
+    def __init__(self, size=100000, path=None, version=None):
+        self.memory = LRUCache(size)
+        self.path = path
+        self.version = version
+        self.stats = {'hits': 0, 'disk': 0, 'misses': 0}
+        if path is not None:
+            if not os.path.exists(path):
+                os.makedirs(path, exist_ok=True)
+            stamp = os.path.join(path, 'VERSION')
+            current = None
+            if os.path.exists(stamp):
+                with open(stamp) as h:
+                    current = h.read().strip()
+            if current != str(version):
+                self.invalidate()
+
+    def keyPath(self, key):
+        return os.path.join(self.path, key[0:2], key+'.npy')
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+        if self.path is not None and os.path.exists(self.keyPath(key)):
+            try:
+                value = np.load(self.keyPath(key))
+                self.memory.put(key, value)
+                self.stats['disk'] += 1
+                return value
+            except Exception:
+                pass
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        value = np.asarray(value, dtype=float)
+        self.memory.put(key, value)
+        if self.path is not None:
+            folder = os.path.dirname(self.keyPath(key))
+            if not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as h:
+                np.save(h, value)
+            os.replace(tmp, self.keyPath(key))
+
+    def invalidate(self):
+        """ Drop all entries, e.g. after changing ranges() or the model templates """
+        self.memory.clear()
+        if self.path is not None:
+            for f in os.listdir(self.path):
+                if len(f) == 2 and os.path.isdir(os.path.join(self.path, f)):
+                    shutil.rmtree(os.path.join(self.path, f))
+            with open(os.path.join(self.path, 'VERSION'), 'w') as h:
+                h.write(str(self.version))
+
+    def summary(self):
+        total = self.stats['hits'] + self.stats['disk'] + self.stats['misses']
+        saved = self.stats['hits'] + self.stats['disk']
+        return "Simulation cache: %d/%d avoided (memory=%d disk=%d)" % (saved, total,
+                                                                         self.stats['hits'], self.stats['disk'])
+
+
+def jsonDefault(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError( type(x) )
+
+
+class DesignCache():
+    """ Persistent store of DoE designs keyed by the design arguments and
+        optimizer settings. Each entry is an npz file: the design matrix M
+        and the other diagnostics as json (entries that are not
+        serializable are not stored). Writes are atomic, and a per-key
+        lock file lets concurrent jobs wait for a design being
+        optimized instead of optimizing it again.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.stats = {'hits': 0, 'misses': 0}
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, **args):
+        text = json.dumps( args, sort_keys=True, default=jsonDefault )
+        return hashlib.sha1( text.encode('utf-8') ).hexdigest()
+
+    def keyPath(self, key):
+        return os.path.join(self.path, key+'.npz')
+
+    def get(self, key):
+        if self.path is None or not os.path.exists(self.keyPath(key)):
+            return None
+        try:
+            with np.load( self.keyPath(key) ) as data:
+                diagnostics = json.loads( str(data['diagnostics']) )
+                diagnostics['M'] = data['M']
+        except Exception:
+            return None
+        return diagnostics
+
+    def put(self, key, diagnostics):
+        if self.path is None:
+            return
+        meta = {}
+        for k, v in diagnostics.items():
+            if k == 'M':
+                continue
+            try:
+                meta[k] = json.loads( json.dumps( v, default=jsonDefault ) )
+            except (TypeError, ValueError):
+                pass
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as h:
+                np.savez_compressed( h, M=np.asarray(diagnostics['M']),
+                                     diagnostics=np.array( json.dumps(meta, default=jsonDefault) ) )
+            os.replace( tmp, self.keyPath(key) )
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @contextmanager
+    def lock(self, key):
+        """ Exclusive lock of a key across processes (fcntl) """
+        import fcntl
+        with open( os.path.join(self.path, key+'.lock'), 'a' ) as h:
+            fcntl.flock( h, fcntl.LOCK_EX )
+            try:
+                yield
+            finally:
+                fcntl.flock( h, fcntl.LOCK_UN )
+
+    def design(self, compute, **args):
+        """ Cached diagnostics of the design with these args, compute() if missing """
+        if self.path is None:
+            return compute()
+        key = self.key(**args)
+        diagnostics = self.get(key)
+        if diagnostics is None:
+            with self.lock(key):
+                # Another process may have stored it while we waited
+                diagnostics = self.get(key)
+                if diagnostics is None:
+                    self.stats['misses'] += 1
+                    diagnostics = compute()
+                    self.put(key, diagnostics)
+                    return diagnostics
+        self.stats['hits'] += 1
+        count('design_hits')
+        return diagnostics
+
+
+# Default store shared by all models built in this process.
+# Set PATHSIM_MODELSTORE to a directory to enable the disk tier.
+modelStore = ModelStore(size=int(os.getenv('PATHSIM_MODELSTORE_SIZE', 64)),
+                        path=os.getenv('PATHSIM_MODELSTORE'))
+
+# Optimal designs, set PATHSIM_DESIGNCACHE to a directory to enable it.
+designCache = DesignCache(os.getenv('PATHSIM_DESIGNCACHE'))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+'''
+ensemble (c) University of Manchester 2019
+
+ensemble is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Vectorized simulation of a batch of linear pathway designs
+'''
+
+import numpy as np
+import time
+
+# Species of each module in the state vector, after the initial substrate
+MODULE = ['Enzyme', 'Inducer', 'Activated_promoter', 'Product']
+KINETICS = ['Catalysis_Km', 'Catalysis_kcat', 'Degradation_k2', 'Induction_n',
+            'Induction_kf1', 'Induction_kr1', 'Leakage_vl']
+
+
+def settled(y, dy, pool, target, remaining, tol=1e-3, atol=1e-12):
+    """ Margin of each design (rows of y and its rates dy) to early termination,
+        <= 0 once the target can no longer change by more than tol (relative):
+        - exhausted: both the upstream substrate pool and the projected target
+          change over the remaining time are below tol*target, or
+        - steady state: no species would change by more than tol*|y| + atol
+    """
+    P = y[:,target]
+    exhausted = np.maximum( np.sum(y[:,pool], axis=1), np.abs(dy[:,target])*remaining ) - tol*P
+    steady = np.max( np.abs(dy)*remaining - tol*np.abs(y) - atol, axis=1 )
+    return np.minimum( exhausted, steady )
+
+
+class PathwayEnsemble():
+    """ Batch of D designs of a n-step pathway integrated as one stiff system.
+        Same rate laws as the modules built by modelTemplate():
+        - Induction: Hill_Coop2 (only modules with their own promoter)
+        - Expression: Copy_number*k1*Activated_promoter, from the promoter
+          pool of the module that drives the step
+        - Leakage, Degradation, Michaelis-Menten Catalysis
+        - Decay of the first substrate (upstream promoter model)
+        State layout per design: [S0, E1, I1, A1, P1, ..., En, In, An, Pn],
+        where Pi is also the substrate of step i+1.
+    """
+    def __init__(self, k1, groups, copy_number, kinetics, decay=None,
+                 substrate=1e-3, inducer=100e-6):
+        """ k1, groups: (D, n) expression constants and promoter modules,
+            copy_number: (D,) or (D, n),
+            kinetics: dict of (D, n) arrays with the KINETICS names,
+            decay: (D,) first substrate decay constants (0 if none)
+        """
+        self.k1 = np.atleast_2d( np.asarray(k1, dtype=float) )
+        self.D, self.n = self.k1.shape
+        self.groups = np.atleast_2d( np.asarray(groups, dtype=int) )
+        self.own = self.groups == np.arange(self.n)
+        copy_number = np.asarray(copy_number, dtype=float)
+        if copy_number.ndim < 2:
+            copy_number = np.repeat( copy_number.reshape(-1,1), self.n, axis=1 )
+        self.vmax = copy_number*self.k1
+        self.kin = { x: np.atleast_2d( np.asarray(kinetics[x], dtype=float) ) for x in KINETICS }
+        if decay is None:
+            decay = np.zeros(self.D)
+        self.decay = np.asarray(decay, dtype=float)*np.ones(self.D)
+        # Flat index of the promoter pool consumed by the expression of each step
+        self.pool = ( np.arange(self.D).reshape(-1,1)*self.n + self.groups ).ravel()
+        self.ns = 4*self.n + 1
+        self.y0 = np.zeros( (self.D, self.ns) )
+        self.y0[:,0] = substrate
+        self.y0[:,2::4] = inducer*self.own
+        self.structure()
+
+    def structure(self):
+        """ Sparsity pattern of the Jacobian. Each step only couples to its
+            neighbours through substrate/product and to the promoter pool
+            that drives it, so the pattern is (nearly) banded in this layout.
+        """
+        D, n, ns = self.D, self.n, self.ns
+        offset = ns*np.arange(D).reshape(-1,1)*np.ones( (1,n), dtype=int )
+        i = np.arange(n)
+        sub = offset + 4*i
+        e = offset + 1 + 4*i
+        ind = offset + 2 + 4*i
+        a = offset + 3 + 4*i
+        p = offset + 4 + 4*i
+        ag = offset + 3 + 4*self.groups
+        # Entries in the order of the values returned by jacobianValues
+        pairs = [ (ind,ind), (ind,a), (a,ind), (a,a), (e,ag), (ag,ag), (e,e),
+                  (sub,e), (sub,sub), (p,e), (p,sub) ]
+        rows = [x[0].ravel() for x in pairs] + [ ns*np.arange(D) ]
+        cols = [x[1].ravel() for x in pairs] + [ ns*np.arange(D) ]
+        self.jrows = np.concatenate(rows)
+        self.jcols = np.concatenate(cols)
+
+    def physical(self):
+        """ Designs whose constants are all non-negative. Noisy draws can
+            give e.g. negative Km, with a singular Michaelis-Menten rate
+        """
+        ok = np.all(self.vmax >= 0, axis=1) & (self.decay >= 0)
+        for x in KINETICS:
+            ok &= np.all(self.kin[x] >= 0, axis=1)
+        return ok
+
+    def speciesIds(self):
+        """ Species names as in the compiled RoadRunner model """
+        ids = ['m1_Substrate']
+        for i in np.arange(self.n):
+            for x in MODULE[0:3]:
+                ids.append( 'm%d_%s' % (i+1, x) )
+            if i < self.n-1:
+                ids.append( 'm%d_Substrate' % (i+2,) )
+            else:
+                ids.append( 'm%d_Product' % (i+1,) )
+        return ids
+
+    def rates(self, t, y):
+        y = y.reshape( (self.D, self.ns) )
+        S = y[:,0::4]
+        E = y[:,1::4]
+        I = y[:,2::4]
+        A = y[:,3::4]
+        kin = self.kin
+        vind = self.own*( kin['Induction_kf1']*np.power(I, kin['Induction_n']) - kin['Induction_kr1']*A )
+        vexp = self.vmax*np.take_along_axis(A, self.groups, axis=1)
+        vdeg = kin['Degradation_k2']*E
+        Ssub = S[:,0:self.n]
+        vcat = kin['Catalysis_kcat']*E*Ssub/(kin['Catalysis_Km'] + Ssub)
+        consumed = np.bincount( self.pool, weights=vexp.ravel(), minlength=self.D*self.n )
+        dy = np.empty_like(y)
+        dy[:,0::4] = 0.0
+        dy[:,0::4][:,0:self.n] -= vcat
+        dy[:,0::4][:,1:] += vcat
+        dy[:,0] -= self.decay*S[:,0]
+        dy[:,1::4] = vexp + kin['Leakage_vl'] - vdeg
+        dy[:,2::4] = -vind
+        dy[:,3::4] = vind - consumed.reshape( (self.D, self.n) )
+        return dy.ravel()
+
+    def sparsity(self):
+        from scipy.sparse import csc_matrix
+        N = self.D*self.ns
+        return csc_matrix( (np.ones(len(self.jrows)), (self.jrows, self.jcols)), shape=(N,N) )
+
+    def jacobian(self, t, y):
+        """ Analytic sparse Jacobian of rates() """
+        from scipy.sparse import csc_matrix
+        y = y.reshape( (self.D, self.ns) )
+        S = y[:,0:4*self.n:4]
+        E = y[:,1::4]
+        I = y[:,2::4]
+        kin = self.kin
+        km = kin['Catalysis_Km']
+        kcat = kin['Catalysis_kcat']
+        dInd = self.own*kin['Induction_kf1']*kin['Induction_n']*np.power(I, kin['Induction_n']-1)
+        kr1 = self.own*kin['Induction_kr1']
+        dE = kcat*S/(km + S)
+        dS = kcat*E*km/np.power(km + S, 2)
+        vals = [ -dInd, kr1, dInd, -kr1, self.vmax, -self.vmax, -kin['Degradation_k2'],
+                 -dE, -dS, dE, dS ]
+        vals = [x.ravel() for x in vals] + [ -self.decay ]
+        N = self.D*self.ns
+        return csc_matrix( (np.concatenate(vals), (self.jrows, self.jcols)), shape=(N,N) )
+
+    def simulate(self, timespan=3600, points=None, rtol=1e-6, atol=1e-12, method='BDF', jac=True,
+                 early=None):
+        """ Integrate all designs. Returns the final state (D, ns) or,
+            if points is given, times and states (D, points, ns).
+            jac=False uses finite differences over the sparsity pattern.
+            early=tol stops once every design is settled(); the stop time is kept in tstop.
+        """
+        from scipy.integrate import solve_ivp
+        t_eval = None
+        if points is not None:
+            t_eval = np.linspace(0, timespan, points)
+        if jac:
+            options = {'jac': self.jacobian}
+        else:
+            options = {'jac_sparsity': self.sparsity()}
+        if early is not None:
+            pool = np.arange(0, 4*self.n, 4)
+            def stop(t, y):
+                dy = self.rates(t, y).reshape( (self.D, self.ns) )
+                return np.max( settled(y.reshape( (self.D, self.ns) ), dy, pool, -1, timespan - t, early, atol) )
+            stop.terminal = True
+            stop.direction = -1
+            options['events'] = stop
+        sol = solve_ivp( self.rates, (0, timespan), self.y0.ravel(), method=method,
+                         t_eval=t_eval, rtol=rtol, atol=atol, **options )
+        if not sol.success:
+            raise Exception(sol.message)
+        self.tstop = sol.t[-1]
+        if early is not None and len(sol.t_events[0]) > 0:
+            self.tstop = sol.t_events[0][0]
+            if points is None:
+                return sol.y_events[0][0].reshape( (self.D, self.ns) )
+        Y = sol.y.reshape( (self.D, self.ns, -1) )
+        if points is None:
+            return Y[:,:,-1]
+        return sol.t, np.transpose(Y, (0,2,1))
+
+    def endpoint(self, timespan=3600, early=None, **kwargs):
+        """ Final concentration of the pathway product for each design.
+            With early termination, also the stop time.
+        """
+        y = self.simulate(timespan, early=early, **kwargs)[:,-1]
+        if early is None:
+            return y
+        return y, self.tstop
+
+
+def randomEnsemble(nsteps, designs=16, seed=0):
+    """ Ensemble with typical constants from the ranges used in pathSim """
+    rng = np.random.RandomState(seed)
+    D, n = designs, nsteps
+    own = rng.random_sample( (D,n) ) < 0.5
+    own[:,0] = True
+    groups = np.maximum.accumulate( np.where(own, np.arange(n), 0), axis=1 )
+    promoters = 1e-8*np.power( 10, rng.random_sample( (D,n) ) )
+    k1 = np.take_along_axis(promoters, groups, axis=1)
+    copy_number = np.power( 10, 2*rng.random_sample(D) )
+    kinetics = {
+        'Catalysis_Km': np.exp( rng.uniform(np.log(1e-4), np.log(1e-2), (D,n)) ),
+        'Catalysis_kcat': np.exp( rng.uniform(np.log(1), np.log(1e3), (D,n)) ),
+        'Degradation_k2': 1e-6*np.ones( (D,n) ),
+        'Induction_n': 2*np.ones( (D,n) ),
+        'Induction_kf1': 1e1*np.ones( (D,n) ),
+        'Induction_kr1': 1e-2*np.ones( (D,n) ),
+        'Leakage_vl': 1e-12*np.ones( (D,n) ),
+        }
+    return PathwayEnsemble( k1, groups, copy_number, kinetics, decay=1e-4 )
+
+def benchmark(steps=(4,8,16,32), designs=16, timespan=3600):
+    """ Solve time versus pathway length, analytic Jacobian vs finite differences """
+    rows = []
+    for n in steps:
+        ens = randomEnsemble(n, designs)
+        row = [n]
+        for jac in (True, False):
+            t0 = time.time()
+            ens.simulate(timespan, jac=jac)
+            row.append( time.time()-t0 )
+        rows.append( row )
+        print( "Steps=%d Analytic=%.3fs FiniteDiff=%.3fs" % tuple(row) )
+    return rows
+
+if __name__ == '__main__':
+    benchmark()
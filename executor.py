@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+'''
+executor (c) University of Manchester 2019
+
+executor is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Serial and process-pool execution of independent designs
+'''
+
+import os, time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import instrument
+
+
+def collect(fn, task):
+    """ Run a task in a worker and return its counter increments with the result,
+        including the CPU time of the task and the peak RSS of the worker
+    """
+    before = instrument.snapshot()
+    c0 = time.process_time()
+    res = fn(task)
+    instrument.count( 'worker_cpu', time.process_time() - c0 )
+    rss = instrument.peakRSS()
+    if rss is not None:
+        instrument.peak( 'worker_rss_mb', rss )
+    return res, instrument.delta(before)
+
+
+class DesignExecutor():
+    """ Map a task over designs, returning results in design order.
+        - workers=1: serial loop in this process (debugging).
+        - workers>1 or None (all cores): process pool. Every worker
+          keeps its own model store, so compiled models are reused
+          across the tasks it receives.
+        - pool: run on an existing process pool (of workers processes),
+          shared with other users and left open on close.
+    """
+    def __init__(self, workers=1, chunksize=None, pool=None):
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.chunksize = chunksize
+        self.pool = pool
+        self.owned = pool is None
+        if pool is None and workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def map(self, fn, tasks):
+        tasks = list(tasks)
+        if self.pool is None:
+            return [fn(t) for t in tasks]
+        chunksize = self.chunksize
+        if chunksize is None:
+            # A few chunks per worker balances load while keeping
+            # similar consecutive designs on the same worker cache
+            chunksize = max(1, int(len(tasks)/(4*self.workers)))
+        results = []
+        for res, increments in self.pool.map(partial(collect, fn), tasks, chunksize=chunksize):
+            instrument.merge(increments)
+            results.append(res)
+        return results
+
+    def close(self):
+        if self.pool is not None and self.owned:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''
+instrument (c) University of Manchester 2019
+
+instrument is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Timing and resource counters of the DBTL phases
+'''
+
+import time, sys, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PHASES = ('Design', 'Build', 'Test', 'Learn')
+METRICS = tuple( ['%s_%s' % (p, x) for p in PHASES for x in ('wall', 'cpu')] ) + (
+    'compiles', 'store_hits', 'store_disk', 'design_hits', 'simulations', 'sim_time_mean',
+    'sim_stop_mean', 'peak_rss_mb', 'peak_rss_children_mb' )
+
+# Process-wide counters. Pool workers send their increments back with
+# each result (see executor), so the parent sees the totals.
+counters = {}
+# Several threads may merge worker increments (see pipeline)
+lock = threading.Lock()
+# Counters that keep a maximum instead of a sum
+MAXIMA = ('worker_rss_mb',)
+
+def count(name, value=1):
+    counters[name] = counters.get(name, 0) + value
+
+def peak(name, value):
+    counters[name] = max( counters.get(name, 0), value )
+
+def snapshot():
+    return dict(counters)
+
+def delta(before):
+    return { k: v if k in MAXIMA else v - before.get(k, 0)
+             for k, v in counters.items() if v != before.get(k, 0) }
+
+def merge(increments):
+    with lock:
+        for k, v in increments.items():
+            if k in MAXIMA:
+                peak(k, v)
+            else:
+                count(k, v)
+
+def peakRSS(children=False):
+    """ Peak resident set size in MB (children: only terminated ones),
+        None where the resource module is not available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage( resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF ).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/2**20
+    return rss/2**10
+
+
+class Instrument():
+    """ Wall/CPU time per phase plus compile, cache and simulation counters.
+        The CPU time of a phase includes the pool workers (worker_cpu, sent
+        with their results), and the peak RSS of the children includes the
+        live workers (worker_rss_mb).
+        The hook, if any, receives the metrics dict when report() is called.
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.phases = OrderedDict()
+        self.start = snapshot()
+
+    @contextmanager
+    def phase(self, name):
+        w0 = time.perf_counter()
+        c0 = time.process_time() + counters.get('worker_cpu', 0.0)
+        try:
+            yield self
+        finally:
+            wall, cpu = self.phases.get(name, (0.0, 0.0))
+            c1 = time.process_time() + counters.get('worker_cpu', 0.0)
+            self.phases[name] = ( wall + time.perf_counter() - w0, cpu + c1 - c0 )
+
+    def metrics(self):
+        m = OrderedDict()
+        for p in PHASES:
+            wall, cpu = self.phases.get(p, (0.0, 0.0))
+            m[p+'_wall'] = wall
+            m[p+'_cpu'] = cpu
+        d = delta(self.start)
+        m['compiles'] = d.get('compiles', 0)
+        m['store_hits'] = d.get('store_hits', 0)
+        m['store_disk'] = d.get('store_disk', 0)
+        m['design_hits'] = d.get('design_hits', 0)
+        m['simulations'] = d.get('simulations', 0)
+        m['sim_time_mean'] = d.get('sim_time', 0.0)/max(1, m['simulations'])
+        # Mean stop time of the simulations with early termination
+        m['sim_stop_mean'] = d.get('sim_stop', 0.0)/max(1, d.get('sim_early', 0))
+        m['peak_rss_mb'] = peakRSS()
+        children = peakRSS(children=True)
+        if children is not None:
+            children = max( children, counters.get('worker_rss_mb', 0) )
+        m['peak_rss_children_mb'] = children
+        for p in self.phases:
+            if p not in PHASES:
+                m[p+'_wall'], m[p+'_cpu'] = self.phases[p]
+        return m
+
+    def report(self):
+        m = self.metrics()
+        if self.hook is not None:
+            self.hook(m)
+        return m
@@ -11,17 +11,19 @@ To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
 @description: Basic pathway simulation
 '''
 
-import tellurium as te
 import numpy as np
 import pandas as pd
-import statsmodels.formula.api as smf
-from statsmodels.tools.eval_measures import iqr, rmse
 from itertools import product
-import re, os, time, csv, argparse
-import matplotlib.pyplot as plt
-#from sampleCompression import evaldes
-from doebase.OptDes import evaldes
-from viscad.viscad import createnewCad, makePDF
+from functools import partial
+import os, time, csv, argparse, hashlib, json
+# tellurium, statsmodels, matplotlib, doebase and viscad are imported
+# where first needed: batch jobs and pool workers only load the
+# simulation stack (see cache.loadAntimony for the headless mode)
+from cache import modelStore, designCache, SimCache, loadAntimony, setHeadless
+from executor import DesignExecutor
+from ensemble import PathwayEnsemble, KINETICS, settled
+from surrogate import encodeLevels, levelFrame, levelTable, ContrastOLS, LinearOLS, RecursiveContrast, rmse, iqr
+from instrument import Instrument, METRICS, count
 
 
 def modelHeader():
@@ -147,7 +149,8 @@ def modelTemplate(promoter, decay=False):
     return antinom
         
         
-def pathway(promoters, decay=True):         
+def pathwayModel(promoters, decay=True):
+    """ Antimony definition of the linear pathway for the promoter pattern """
     antinom = modelHeader()
     if decay:
         antinom += modelTemplate(1, decay)  
@@ -173,7 +176,80 @@ def pathway(promoters, decay=True):
             antinom += "\t"+"m%d.Activated_promoter is m%d.Activated_promoter" %(i+1,i)
             antinom += "\n"
     antinom += "end\n"
-    return te.loada(antinom)
+    return antinom
+
+def supersetModel(nsteps):
+    """ Antimony definition of the nsteps pathway containing every topology.
+        All modules have the promoter machinery; the topology is set by parameters:
+        - m<i>_Own: 1 if the step has its own promoter, 0 if it is driven upstream
+        - m1_Kd: decay of the first substrate (0 without the upstream model)
+        m<i>_Promoter is the promoter pool driving step i; the pool of a group
+        head is consumed by the expression of all the steps it drives (m<i>_Demand).
+    """
+    antinom = modelHeader()
+    antinom += "model *Superset_Model()\n"
+    antinom += "\tcompartment Cell;\n\tCell = 1;\n\tconst Cell;\n"
+    for i in np.arange(1, nsteps+1):
+        m = 'm%d_' % (i,)
+        sub = m+'Substrate'
+        prod = 'm%d_Substrate' % (i+1,) if i < nsteps else m+'Product'
+        antinom += "\tspecies %s in Cell, %sEnzyme in Cell, %sInducer in Cell, %sActivated_promoter in Cell;\n" % (sub, m, m, m)
+        if i == nsteps:
+            antinom += "\tspecies %s in Cell;\n" % (prod,)
+        antinom += "\t%sInduction: %sInducer => %sActivated_promoter; Cell*%sOwn*Hill_Coop2(%sInducer, %sActivated_promoter, %sInduction_n, %sInduction_kf1, %sInduction_kr1);\n" % ((m,)*9)
+        antinom += "\t%sExpression: => %sEnzyme; %sCopy_number*Cell*%sExpression_k1*%sPromoter;\n" % ((m,)*5)
+        antinom += "\t%sDrain: %sActivated_promoter => ; Cell*%sOwn*%sDemand*%sActivated_promoter;\n" % ((m,)*5)
+        antinom += "\t%sLeakage: => %sEnzyme; Cell*Constant_flux__irreversible(%sLeakage_vl);\n" % ((m,)*3)
+        antinom += "\t%sDegradation: %sEnzyme => ; Cell*%sDegradation_k2*%sEnzyme;\n" % ((m,)*4)
+        antinom += "\t%sCatalysis: %s => %s; Cell*Henri_Michaelis_Menten__irreversible(%s, %sEnzyme, %sCatalysis_Km, %sCatalysis_kcat);\n" % (m, sub, prod, sub, m, m, m)
+        if i == 1:
+            antinom += "\t%sDecay: %s -> ; Cell*%sKd*%s;\n" % (m, sub, m, sub)
+            antinom += "\t%sPromoter := %sOwn*%sActivated_promoter;\n" % (m, m, m)
+        else:
+            antinom += "\t%sPromoter := %sOwn*%sActivated_promoter + (1 - %sOwn)*m%d_Promoter;\n" % (m, m, m, m, i-1)
+        if i < nsteps:
+            antinom += "\t%sDemand := %sCopy_number*%sExpression_k1 + (1 - m%d_Own)*m%d_Demand;\n" % (m, m, m, i+1, i+1)
+        else:
+            antinom += "\t%sDemand := %sCopy_number*%sExpression_k1;\n" % (m, m, m)
+        # Initial values as in modelTemplate()
+        antinom += "\t%s = 0.5*1e-9;\n\t%sEnzyme = 0;\n\t%sInducer = 1e-2;\n\t%sActivated_promoter = 0;\n" % (sub, m, m, m)
+        if i == nsteps:
+            antinom += "\t%s = 0;\n" % (prod,)
+        if i == 1:
+            antinom += "\t%sKd = 1e-4;\n" % (m,)
+        antinom += "\t%sOwn = 1;\n\t%sCopy_number = 1;\n\t%sInduction_n = 1.85;\n\t%sInduction_kf1 = 1e3;\n\t%sInduction_kr1 = 1e-1;\n" % ((m,)*5)
+        antinom += "\t%sExpression_k1 = 1e6;\n\t%sLeakage_vl = 0;\n\t%sDegradation_k2 = 1e-6;\n\t%sCatalysis_Km = 0.1;\n\t%sCatalysis_kcat = 0.1;\n" % ((m,)*5)
+    antinom += "end\n"
+    return antinom
+
+def setSuperset(flag=True):
+    """ Build every design of a pathway length on its superset model,
+        also for worker processes started later
+    """
+    global SUPERSET
+    SUPERSET = flag
+    if flag:
+        os.environ['PATHSIM_SUPERSET'] = '1'
+    else:
+        os.environ.pop('PATHSIM_SUPERSET', None)
+
+# One compiled model per pathway length instead of one per promoter pattern
+SUPERSET = os.getenv('PATHSIM_SUPERSET') is not None
+
+def pathway(promoters, decay=True, store=modelStore, private=True):
+    """ Compiled pathway model, reused from the model store when available.
+        With private=False the stored model itself is returned, shared with
+        the next pathway of the same topology (see ModelStore.load).
+        In superset mode the model only depends on the number of steps
+        (the topology is then set by the design plan).
+    """
+    if SUPERSET:
+        antinom = supersetModel(len(promoters))
+    else:
+        antinom = pathwayModel(promoters, decay)
+    if store is None:
+        return loadAntimony(antinom)
+    return store.load(antinom, private)
 
 
 class Model():
@@ -265,7 +341,8 @@ def Parameters(nori,nprom,nsteps,nvariants):
         par['Step'].append( vals )
     return par
             
-def Construct(par,design,noise=False):
+def Promoters(par, design):
+    """ Promoter strength at each step, None if the step has no promoter """
     promoters = []
     for x in np.arange(1,len(design),2):
         # Backbone promoter
@@ -277,35 +354,184 @@ def Construct(par,design,noise=False):
                 promoters.append( None )
             else:
                 promoters.append( par['Expression'][design[x]-1] )
-    # Use the information about promoters to create the pathway  
-    pw = pathway(promoters)
-    initModel( pw, nsteps=len(par['Step']), substrate=1.0*1e-3 )
-    # Init model??
-    # Set up the copy number
-    for i in np.arange(len(par['Step'])):
-        pw['m'+str(i+1)+'_Copy_number'] = float(par['Copy_number'][design[0]])
-    for i in np.arange(len(par['Step'])):
-        if promoters[i] is not None:
-            pw['m'+str(i+1)+'_Expression_k1'] = promoters[i]
-        else:
-            j = i-1
-            while promoters[j] is None and j > 0:
-                j -= 1
-            pw['m'+str(i+1)+'_Expression_k1'] = promoters[j]
-            
-    # Set up the gene
+    return promoters
+
+def promoterGroups(promoters):
+    """ Step whose promoter drives the expression at each step """
+    groups = []
+    for i in np.arange(len(promoters)):
+        j = i
+        while promoters[j] is None and j > 0:
+            j -= 1
+        groups.append( j )
+    return groups
+
+def Kinetics(par, design, noise=False, rng=None):
+    """ Kinetic parameters of the enzyme variant selected at each step """
+    kinetics = []
     for i in np.arange(len(par['Step'])):
         enzyme = par['Step'][i][design[2+i*2]]
+        vals = {}
         for val in enzyme:
             (mean, std) = enzyme[val]
             if noise:
-                p = np.random.normal( mean, std )
+                if rng is None:
+                    p = np.random.normal( mean, std )
+                else:
+                    p = rng.normal( mean, std )
             else:
                 p = mean
-            param = 'm{}_{}'.format( i+1, val )
-            pw[ param ] = p
+            vals[val] = p
+        kinetics.append( vals )
+    return kinetics
+
+def designVector(par, design, promoters, noise=False, rng=None):
+    """ Copy numbers, expression constants and kinetics of all steps
+        as one vector: [Copy_number (n), Expression_k1 (n), KINETICS (n each)]
+    """
+    n = len(promoters)
+    v = np.empty( (2+len(KINETICS))*n )
+    v[0:n] = float(par['Copy_number'][design[0]])
+    v[n:2*n] = [ promoters[j] for j in promoterGroups(promoters) ]
+    kinetics = Kinetics(par, design, noise, rng)
+    for k, x in enumerate(KINETICS):
+        v[(2+k)*n:(3+k)*n] = [ kin[x] for kin in kinetics ]
+    return v
+
+def designMoments(par, design, promoters):
+    """ Mean and standard deviation of the design vector under noise """
+    n = len(promoters)
+    mean = designVector(par, design, promoters)
+    std = np.zeros( len(mean) )
+    for k, x in enumerate(KINETICS):
+        std[(2+k)*n:(3+k)*n] = [ par['Step'][i][design[2+i*2]][x][1] for i in np.arange(n) ]
+    return mean, std
+
+def vectorEnsemble(V, groups, upstream):
+    """ Ensemble from design vectors (one row per simulation) """
+    V = np.atleast_2d(V)
+    n = np.shape(groups)[-1]
+    kinetics = { x: V[:,(2+k)*n:(3+k)*n] for k, x in enumerate(KINETICS) }
+    return PathwayEnsemble( V[:,n:2*n], groups, V[:,0:n], kinetics, decay=upstream, substrate=1.0*1e-3 )
+
+class DesignPlan():
+    """ Compiled mapping from a design to the values of a pathway model.
+        Built once per model structure: parameter and species names are
+        resolved to indices, so setting up a design is one bulk write.
+    """
+    def __init__(self, pw, nsteps, substrate=1.0*1e-3, inducer=100e-6):
+        self.nsteps = nsteps
+        params = list( pw.model.getGlobalParameterIds() )
+        species = list( pw.model.getFloatingSpeciesIds() )
+        names = []
+        for x in ['Copy_number', 'Expression_k1'] + KINETICS:
+            names.extend( ['m%d_%s' % (i+1, x) for i in np.arange(nsteps)] )
+        self.pidx = np.array( [params.index(x) for x in names], dtype=np.int32 )
+        # initModel: everything empty but the first substrate and the inducers
+        self.sidx = np.arange( len(species), dtype=np.int32 )
+        self.s0 = np.zeros( len(species) )
+        for i, x in enumerate(species):
+            if x.endswith('_Inducer'):
+                self.s0[i] = inducer
+        self.s0[ species.index('m1_Substrate') ] = substrate
+
+    def vector(self, par, design, promoters, noise=False, rng=None):
+        """ Parameter vector of a design, in the order of pidx """
+        return designVector(par, design, promoters, noise, rng)
+
+    def apply(self, pw, values):
+        pw.model.setGlobalParameterValues( self.pidx, values )
+        pw.model.setFloatingSpeciesConcentrations( self.sidx, self.s0 )
+
+class SupersetPlan(DesignPlan):
+    """ Design plan of a promoter pattern on the superset model:
+        also sets the topology switches (own promoters and upstream decay)
+    """
+    def __init__(self, pw, promoters, decay=1e-4, substrate=1.0*1e-3, inducer=100e-6):
+        DesignPlan.__init__(self, pw, len(promoters), substrate, inducer)
+        params = list( pw.model.getGlobalParameterIds() )
+        names = ['m%d_Own' % (i+1,) for i in np.arange(self.nsteps)] + ['m1_Kd']
+        self.tidx = np.array( [params.index(x) for x in names], dtype=np.int32 )
+        self.tvals = np.array( [float(p is not None) for p in promoters] +
+                               [decay if promoters[0] is not None else 0.0] )
+
+    def apply(self, pw, values):
+        pw.model.setGlobalParameterValues( self.tidx, self.tvals )
+        DesignPlan.apply(self, pw, values)
+
+# Design plans by promoter pattern
+designPlans = {}
+
+def designPlan(pw, promoters):
+    key = (SUPERSET,) + tuple( [p is None for p in promoters] )
+    if key not in designPlans:
+        if SUPERSET:
+            designPlans[key] = SupersetPlan( pw, promoters )
+        else:
+            designPlans[key] = DesignPlan( pw, len(promoters) )
+    return designPlans[key]
+
+def Construct(par,design,noise=False,rng=None,private=True):
+    """ Pathway model of a design. With private=False, the model is shared
+        with the next Construct of the same topology (see pathway)
+    """
+    promoters = Promoters(par, design)
+    # Use the information about promoters to create the pathway  
+    pw = pathway(promoters, private=private)
+    # Init model, copy number, promoters and genes in one write
+    plan = designPlan(pw, promoters)
+    plan.apply( pw, plan.vector(par, design, promoters, noise, rng) )
     return pw
-        
+
+def Ensemble(par, designs, index=None, noise=False, seed=None, decay=1e-4):
+    """ Vectorized counterpart of Construct for a batch of designs """
+    if index is None:
+        index = np.arange(len(designs))
+    V = []
+    groups = []
+    upstream = []
+    for i, design in zip(index, designs):
+        promoters = Promoters(par, design)
+        groups.append( promoterGroups(promoters) )
+        upstream.append( decay if promoters[0] is not None else 0.0 )
+        V.append( designVector(par, design, promoters, noise, designRng(seed, i)) )
+    return vectorEnsemble( V, groups, upstream )
+
+def Replicates(par, design, nrep=10, timespan=3600, rng=None, backend='tellurium',
+               quantiles=(0.05, 0.5, 0.95), decay=1e-4):
+    """ Endpoint statistics of nrep noisy replicates of a design.
+        All replicate vectors are drawn at once and simulated on a single
+        compiled model (or as one ensemble batch).
+    """
+    if rng is None:
+        rng = np.random
+    promoters = Promoters(par, design)
+    mean, std = designMoments(par, design, promoters)
+    V = rng.normal( mean, std, size=(nrep, len(mean)) )
+    y = np.empty(nrep)
+    todo = np.ones(nrep, dtype=bool)
+    if backend == 'ensemble':
+        groups = [ promoterGroups(promoters) ]*nrep
+        upstream = decay if promoters[0] is not None else 0.0
+        ens = vectorEnsemble( V, groups, upstream )
+        # Unphysical draws are left to RoadRunner
+        ok = ens.physical()
+        if np.any(ok):
+            y[ok] = vectorEnsemble( V[ok], groups[0:int(np.sum(ok))], upstream ).endpoint(timespan)
+            todo = ~ok
+    if np.any(todo):
+        pw = pathway(promoters, private=False)
+        plan = designPlan(pw, promoters)
+        for j in np.flatnonzero(todo):
+            plan.apply( pw, V[j] )
+            y[j] = Endpoint(pw, timespan)
+    return replicateSummary(y, quantiles)
+
+def replicateSummary(y, quantiles=(0.05, 0.5, 0.95)):
+    summary = { 'n': len(y), 'mean': np.mean(y), 'std': np.std(y, ddof=1) if len(y) > 1 else 0.0 }
+    for q in quantiles:
+        summary[ 'q%g' % (100*q,) ] = np.quantile(y, q)
+    return summary
 
 def instance():
     """ Generate an instance mean, std """
@@ -395,6 +621,222 @@ def SelectCurves(pw):
     pw.steadyStateSelections = selections
     return target
 
+def Readouts(pw):
+    """ Final product of the pathway """
+    return [ '['+x+']' for x in pw.model.getFloatingSpeciesIds() if x.endswith('Product') ]
+
+def Endpoint(pw, timespan=3600, readouts=None):
+    """ Integrate straight to timespan without dense output.
+        Returns the final target concentration or the requested readouts.
+    """
+    t0 = time.perf_counter()
+    pw.oneStep(0, timespan)
+    count('simulations')
+    count('sim_time', time.perf_counter()-t0)
+    if readouts is None:
+        return pw[ Readouts(pw)[0] ]
+    return np.array( [pw[x] for x in readouts] )
+
+def EarlyEndpoint(pw, timespan=3600, tol=1e-3, checks=6, atol=1e-12):
+    """ Endpoint with early termination: the pathway is checked at log-spaced
+        times timespan/2**checks, ..., timespan/2 and integration stops once it
+        is settled (see ensemble.settled).
+        Returns the final target concentration and the stop time.
+    """
+    ids = pw.model.getFloatingSpeciesIds()
+    target = [ j for j, x in enumerate(ids) if x.endswith('Product') ][0]
+    pool = [ j for j, x in enumerate(ids) if x.endswith('Substrate') ]
+    stops = timespan*np.power( 2.0, -np.arange(checks, -1, -1) )
+    t0 = time.perf_counter()
+    # The first step resets the integrator to the current model state
+    t = pw.oneStep(0, stops[0])
+    for tnext in stops[1:]:
+        y = pw.model.getFloatingSpeciesConcentrations().reshape(1,-1)
+        dy = pw.model.getFloatingSpeciesConcentrationRates().reshape(1,-1)
+        if settled(y, dy, pool, target, timespan - t, tol, atol)[0] <= 0:
+            break
+        t = pw.oneStep(t, tnext - t, False)
+    count('simulations')
+    count('sim_time', time.perf_counter()-t0)
+    count('sim_early')
+    count('sim_stop', t)
+    return pw[ Readouts(pw)[0] ], t
+
+def modelVersion():
+    """ Fingerprint of the model templates and parameter ranges """
+    text = modelHeader() + modelTemplate(1, True) + modelTemplate(1) + modelTemplate(None) + supersetModel(2)
+    text += json.dumps( ranges(), sort_keys=True )
+    return hashlib.sha1( text.encode('utf-8') ).hexdigest()
+
+def simulationCache(size=100000, path=None):
+    """ Simulation cache tied to the current model version """
+    return SimCache(size, path, modelVersion())
+
+def designKey(par, design, timespan=3600, backend='tellurium', seed=None, early=None):
+    """ Content key of a design simulation: the assembled design, the slice of
+        par it uses (promoters, copy number, variant kinetics), timespan, noise seed
+        and early termination tolerance
+    """
+    promoters = Promoters(par, design)
+    mean, std = designMoments(par, design, promoters)
+    h = hashlib.sha1()
+    h.update( np.asarray(design, dtype=np.int64).tobytes() )
+    h.update( np.asarray([p is None for p in promoters]).tobytes() )
+    h.update( mean.tobytes() )
+    h.update( std.tobytes() )
+    h.update( repr( (float(timespan), backend, seed) ).encode('utf-8') )
+    if early is not None:
+        h.update( repr( ('early', float(early)) ).encode('utf-8') )
+    return h.hexdigest()
+
+def designRng(seed, i):
+    """ Per-design generator, independent of execution order and worker count """
+    if seed is None:
+        return None
+    return np.random.default_rng( [seed, i] )
+
+def selectedSpecies(names):
+    """ Species kept in trajectories (as in SelectCurves) """
+    return [ x for x in names if not ( x.endswith('Inducer') or x.endswith('promoter') or
+                                       x.endswith('Enzyme') or x.endswith('Growth') ) ]
+
+def productEndpoint(trajectory):
+    """ Final product concentration of a (species, time, values) trajectory """
+    names, t, Y = trajectory
+    return Y[-1, [j for j, x in enumerate(names) if x.endswith('Product')][0]]
+
+def simulateTask(par, task, timespan=3600, noise=False, points=None, early=None):
+    """ Build and test a single design: the unit of work of the executor.
+        Returns the endpoint or, if points is given, the trajectory
+        (species, time, values) of the selected species.
+        early: tolerance of the early termination of endpoint simulations.
+    """
+    i, design, seed = task
+    pw = Construct(par, design, noise=noise, rng=designRng(seed, i), private=False)
+    if points is None and early is not None:
+        return EarlyEndpoint(pw, timespan, early)[0]
+    if points is None:
+        return Endpoint(pw, timespan)
+    SelectCurves(pw)
+    t0 = time.perf_counter()
+    s = pw.simulate(0, timespan, points)
+    count('simulations')
+    count('sim_time', time.perf_counter()-t0)
+    names = [ x.strip('[]') for x in s.colnames[1:] ]
+    s = np.array(s)
+    return names, s[:,0], s[:,1:]
+
+def replicateTask(par, task, timespan=3600, replicates=10, backend='tellurium'):
+    """ Replicate statistics of a single design """
+    i, design, seed = task
+    return Replicates(par, design, replicates, timespan, rng=designRng(seed, i), backend=backend)
+
+def ensembleTask(par, task, timespan=3600, noise=False, points=None, early=None):
+    """ Build and test a batch of designs with the vectorized backend.
+        If the batch fails to integrate (e.g. negative noisy constants),
+        it is split until the failing designs run alone with RoadRunner.
+    """
+    index, designs, seed = task
+    ens = Ensemble(par, designs, index, noise, seed)
+    ok = ens.physical()
+    if not np.all(ok):
+        res = [None]*len(designs)
+        valid = [j for j in np.arange(len(designs)) if ok[j]]
+        if len(valid) > 0:
+            y = ensembleTask(par, ([index[j] for j in valid], [designs[j] for j in valid], seed), timespan, noise, points, early)
+            for j, v in zip(valid, y):
+                res[j] = v
+        for j in np.arange(len(designs)):
+            if not ok[j]:
+                res[j] = simulateTask(par, (index[j], designs[j], seed), timespan, noise, points, early)
+        return res
+    try:
+        t0 = time.perf_counter()
+        if points is None and early is not None:
+            y, tstop = ens.endpoint(timespan, early=early)
+            count('simulations', len(designs))
+            count('sim_time', time.perf_counter()-t0)
+            count('sim_early', len(designs))
+            count('sim_stop', len(designs)*tstop)
+            return list( y )
+        if points is None:
+            y = list( ens.endpoint(timespan) )
+            count('simulations', len(designs))
+            count('sim_time', time.perf_counter()-t0)
+            return y
+        t, Y = ens.simulate(timespan, points)
+        count('simulations', len(designs))
+        count('sim_time', time.perf_counter()-t0)
+        ids = ens.speciesIds()
+        names = selectedSpecies(ids)
+        sel = [ ids.index(x) for x in names ]
+        return [ (names, t, Y[d][:,sel]) for d in np.arange(Y.shape[0]) ]
+    except Exception:
+        if len(designs) == 1:
+            return [ simulateTask(par, (index[0], designs[0], seed), timespan, noise, points, early) ]
+        h = int(len(designs)/2)
+        return ( ensembleTask(par, (index[:h], designs[:h], seed), timespan, noise, points, early) +
+                 ensembleTask(par, (index[h:], designs[h:], seed), timespan, noise, points, early) )
+
+def runDesigns(par, designs, index=None, timespan=3600, noise=False, seed=None, executor=None,
+               backend='tellurium', batch=256, replicates=None, points=None, simcache=None, early=None):
+    """ Simulate the endpoint of each design, results in design order.
+        Backends: 'tellurium' (one RoadRunner model per design) or
+        'ensemble' (batches of designs integrated together).
+        With replicates, returns the replicate statistics of each design.
+        With points, returns the trajectory of each design.
+        With a simcache, only designs not simulated before are run.
+        With early (a tolerance), endpoints stop once the pathway is settled.
+    """
+    if index is None:
+        index = np.arange(len(designs))
+    if executor is None:
+        executor = DesignExecutor(1)
+    if simcache is not None and replicates is None and points is None:
+        keys = [ designKey(par, design, timespan, backend, (seed, int(i)) if noise else None, early)
+                 for i, design in zip(index, designs) ]
+        results = [ simcache.get(k) for k in keys ]
+        todo = [ j for j in np.arange(len(designs)) if results[j] is None ]
+        if len(todo) > 0:
+            y = runDesigns(par, [designs[j] for j in todo], np.asarray(index)[todo], timespan, noise, seed,
+                           executor, backend, batch, early=early)
+            for j, v in zip(todo, y):
+                simcache.put( keys[j], v )
+                results[j] = v
+        return [ float(x) for x in results ]
+    if replicates is not None:
+        if seed is None:
+            seed = np.random.randint(2**31)
+        tasks = [ (int(i), design, seed) for i, design in zip(index, designs) ]
+        fn = partial(replicateTask, par, timespan=timespan, replicates=replicates, backend=backend)
+        return executor.map(fn, tasks)
+    if backend == 'ensemble':
+        tasks = [ ([int(i) for i in index[j:j+batch]], designs[j:j+batch], seed)
+                  for j in np.arange(0, len(designs), batch) ]
+        fn = partial(ensembleTask, par, timespan=timespan, noise=noise, points=points, early=early)
+        return [ y for res in executor.map(fn, tasks) for y in res ]
+    tasks = [ (int(i), design, seed) for i, design in zip(index, designs) ]
+    fn = partial(simulateTask, par, timespan=timespan, noise=noise, points=points, early=early)
+    return executor.map(fn, tasks)
+
+def recordDesigns(sink, run, par, designs, index=None, points=1000, **kwargs):
+    """ Simulate trajectories and append them to the sink in blocks
+        of sink.batch designs, so memory stays bounded. Returns the endpoints.
+    """
+    if index is None:
+        index = np.arange(len(designs))
+    if run is None:
+        run = time.strftime("%Y-%m-%d-%H-%M-%S")
+    results = []
+    for j in np.arange(0, len(designs), sink.batch):
+        block = runDesigns(par, designs[j:j+sink.batch], index=index[j:j+sink.batch], points=points, **kwargs)
+        for i, trajectory in zip(index[j:j+sink.batch], block):
+            y = productEndpoint(trajectory)
+            sink.append( run, i, trajectory[0], trajectory[1], trajectory[2], y )
+            results.append( y )
+    sink.flush()
+    return results
+
 def Assembly(design, steps=3, nplasmids=2, npromoters=2, variants=3):
     """ Assembly the full pathway: provide the index at each position """
     assemble = []
@@ -432,7 +874,16 @@ def Assembly(design, steps=3, nplasmids=2, npromoters=2, variants=3):
         assemble.append( design[p+1] )
     return assemble
        
-def SimulateDesign(steps=3, nplasmids=2, npromoters=2, variants=3, libsize=32, show=False, timespan=3600, random=False):
+def SimulateDesign(steps=3, nplasmids=2, npromoters=2, variants=3, libsize=32, show=False, timespan=3600, random=False,
+                   noise=False, seed=None, executor=None, backend='tellurium', replicates=None,
+                   sink=None, run=None, simcache=None, doe=None, instrument=None, early=None, cache=None,
+                   starts=1, workers=1, doeBudget=None):
+    """ Design (doe defaults to sampleCompression.evaldes, with the design
+        cache, designCache by default, and starts optimizer starts on
+        workers processes within doeBudget seconds), build and test a DoE library
+    """
+    if instrument is None:
+        instrument = Instrument()
     print('Design')
     steps = steps
     variants = variants
@@ -440,109 +891,328 @@ def SimulateDesign(steps=3, nplasmids=2, npromoters=2, variants=3, libsize=32, s
     nplasmids = nplasmids
     libsize = libsize
     positional = False
-    par = Parameters(nplasmids,npromoters,steps,variants)
-    diagnostics = evaldes( steps, variants, npromoters, nplasmids, libsize, positional, random=random )
-    M = diagnostics['M']
+    with instrument.phase('Design'):
+        par = Parameters(nplasmids,npromoters,steps,variants)
+        if doe is None:
+            from sampleCompression import evaldes
+            doe = partial( evaldes, cache=designCache if cache is None else cache,
+                           starts=starts, workers=workers, budget=doeBudget )
+        diagnostics = doe( steps, variants, npromoters, nplasmids, libsize, positional, random=random )
+        M = diagnostics['M']
     print('Build')
-    results = []
-    for i in np.arange(M.shape[0]):
-        design = Assembly( M[i,:], steps, nplasmids, npromoters, variants  )        
-        pw = Construct(par,design)
-        target = SelectCurves(pw)
-        s = pw.simulate(0,timespan,1000)
-        if show:
-            pw.plot(s, show=False ,xlabel='t [s]', ylabel="conc [M]")
-        ds = pd.DataFrame(s,columns=s.colnames)
-        results.append( s[target][-1] )
+    with instrument.phase('Build'):
+        pw, ds, results = buildLibrary(par, M, diagnostics, steps, nplasmids, npromoters, variants, show,
+                                       timespan, noise, seed, executor, backend, replicates, sink, run, simcache,
+                                       early)
     return pw, ds, M, results, par, diagnostics
 
-# TO DO: multiple random sims per design? (but with same params)
+def buildLibrary(par, M, diagnostics, steps, nplasmids, npromoters, variants, show=False, timespan=3600,
+                 noise=False, seed=None, executor=None, backend='tellurium', replicates=None,
+                 sink=None, run=None, simcache=None, early=None):
+    """ Build and test the designs of a DoE matrix """
+    if noise and seed is None:
+        seed = np.random.randint(2**31)
+    designs = [ Assembly( M[i,:], steps, nplasmids, npromoters, variants  ) for i in np.arange(M.shape[0]) ]
+    pw = None
+    ds = None
+    if show:
+        results = []
+        for i in np.arange(M.shape[0]):
+            # The last model is returned to the caller
+            pw = Construct(par,designs[i],noise=noise,rng=designRng(seed, i))
+            target = SelectCurves(pw)
+            s = pw.simulate(0,timespan,1000)
+            pw.plot(s, show=False ,xlabel='t [s]', ylabel="conc [M]")
+            ds = pd.DataFrame(s,columns=s.colnames)
+            results.append( s[target][-1] )
+    elif sink is not None:
+        # Keep the trajectories in the results store
+        results = recordDesigns(sink, run, par, designs, timespan=timespan, noise=noise, seed=seed,
+                                executor=executor, backend=backend)
+    elif replicates is not None:
+        # Noisy replicates with the same parameters: fit on their mean
+        stats = runDesigns(par, designs, timespan=timespan, seed=seed, executor=executor,
+                           backend=backend, replicates=replicates)
+        diagnostics['replicates'] = pd.DataFrame( stats )
+        results = [ x['mean'] for x in stats ]
+    else:
+        results = runDesigns(par, designs, timespan=timespan, noise=noise, seed=seed, executor=executor,
+                             backend=backend, simcache=simcache, early=early)
+    return pw, ds, results
 
-def FitModel(M,results):
+def FitModel(M,results,fast=False,incremental=False,library=None):
+    """ Contrast model of the results on the design factor levels.
+        fast=True solves it by direct least squares instead of statsmodels,
+        incremental=True returns a model that UpdateModel extends with new designs.
+        Its factor levels and promoter caps are those of library (by default M),
+        e.g. the full DoE matrix when M is only its first batch.
+    """
     columns = ['C'+str(i) for i in np.arange(M.shape[1])]
-    dd = pd.DataFrame( M, columns=columns )
-    promLevels = []
-    for j in np.arange(3,dd.shape[1],2):
-        promLevels.append( int(len(dd.iloc[:,j].unique())/2) )  
-    for i in np.arange(M.shape[0]):
-        for j in np.arange(M.shape[1]):
-            # Add exception for promoters
-            dd.iloc[i,j] = "L"+str(M[i,j])
-            if j>2 and ( (j+1) % 2 == 0):
-                plevel = promLevels[ int( (j-3)/2 ) ]
-                if M[i,j] > plevel-1:
-                    dd.iloc[i,j] = "L"+str(plevel)
-                else:
-                    dd.iloc[i,j] = "L"+str(M[i,j])
-                
+    if incremental:
+        if library is None:
+            library = M
+        res = RecursiveContrast( levelFrame( encodeLevels(library), columns ) )
+        UpdateModel( res, M, results )
+        dd = levelFrame( encodeLevels( M, levelCaps(res) ), columns, res.levels )
+        dd['y'] = results
+        return res, dd
+    # Add exception for promoters
+    dd = levelFrame( encodeLevels(M), columns )
     dd['y'] = results
-    formula = 'y ~ '+' + '.join(columns)
-    ols = smf.ols( formula=formula, data=dd)
-    res = ols.fit()
+    if fast:
+        res = ContrastOLS( dd )
+    else:
+        import statsmodels.formula.api as smf
+        formula = 'y ~ '+' + '.join(columns)
+        ols = smf.ols( formula=formula, data=dd)
+        res = ols.fit()
     return res, dd
 
-def BestCombinations(res, dd, random=1000):
+def levelCaps(res):
+    """ Promoter caps of an incremental model (see encodeLevels) """
+    return [ np.max(x) for x in res.levels ]
+
+def UpdateModel(res, M, results):
+    """ Add a batch of simulated designs to a model from FitModel(incremental=True).
+        The designs are encoded with the levels of the model's library.
+    """
+    codes = encodeLevels( M, levelCaps(res) )
+    res.update( levelFrame( codes, res.factors, res.levels ), results )
+    return res
+
+def BestCombinations(res, dd, random=1000, top=None, reservoir=0, chunk=100000, rng=None):
+    """ Rank predicted combinations: a random sample or the full library.
+        With random=None and top=k the full library is streamed in chunks,
+        keeping only the k best and (optionally) a uniform reservoir sample.
+        rng: random generator (RandomState API), np.random by default.
+    """
+    if rng is None:
+        rng = np.random
     levels = []
     for j in np.arange(dd.shape[1]-1):
-        levels.append( dd.iloc[:,j].unique() )
+        levels.append( np.asarray( dd.iloc[:,j].unique() ) )
+    if random is None and top is not None:
+        return streamCombinations(res, dd.columns[0:-1], levels, top, reservoir, chunk, rng)
     comb = []
     if random is None:
         # Full library
-        for combo in product( *levels ):
-            comb.append( combo )
+        comb = np.array( list( product( *levels ) ) )
     else:
         comb = []
         for x in levels:
-            comb.append( x[ np.random.randint(len(x), size=random ) ] )
+            comb.append( x[ rng.randint(len(x), size=random ) ] )
         comb = np.transpose( np.array(comb) )
         
-    ndata = pd.DataFrame( comb, columns=dd.columns[0:-1] )
+    ndata = levelFrame( comb, dd.columns[0:-1], [np.sort(x) for x in levels] )
     ndata['pred'] = res.predict( ndata )
     ndata = ndata.sort_values(by='pred', ascending=False)
     ndata = ndata.reset_index(drop=True)
     return ndata
 
-def ValidatePred(ndata, par, steps, nplasmids, npromoters, variants, random=100, timespan=3600):
-    """ Simulating all combinations will become too expensive with large sets! """
-    """ Alternative ask for a random sample """
-    if random is None:
-        points = np.arange(ndata.shape[0])
+def decodeCombinations(flat, radix):
+    """ Level indices of combinations numbered in itertools.product order """
+    idx = np.empty( (len(flat), len(radix)), dtype=np.int64 )
+    for j in np.arange(len(radix)-1, -1, -1):
+        idx[:,j] = flat % radix[j]
+        flat = flat // radix[j]
+    return idx
+
+def streamCombinations(res, columns, levels, top=100, reservoir=0, chunk=100000, rng=None):
+    """ Bounded-memory top-k search over product(*levels) for an additive model.
+        With a reservoir sample the rows are flagged in the 'top' column
+        (the top-k rows come first, the rest are the sample).
+    """
+    if rng is None:
+        rng = np.random
+    intercept, table = levelTable(res, columns, levels)
+    radix = [len(x) for x in levels]
+    total = int( np.prod( [float(r) for r in radix] ) )
+    if total >= 2**63:
+        raise Exception('Library too large to enumerate')
+    best = np.zeros(0, dtype=np.int64)
+    bestScore = np.zeros(0)
+    sample = np.zeros(0, dtype=np.int64)
+    priority = np.zeros(0)
+    for start in np.arange(0, total, chunk, dtype=np.int64):
+        flat = np.arange( start, min(start+chunk, total), dtype=np.int64 )
+        idx = decodeCombinations(flat, radix)
+        score = intercept + np.sum( [table[j][idx[:,j]] for j in np.arange(len(radix))], axis=0 )
+        best = np.concatenate( [best, flat] )
+        bestScore = np.concatenate( [bestScore, score] )
+        if len(best) > top:
+            keep = np.argpartition( -bestScore, top-1 )[0:top]
+            best, bestScore = best[keep], bestScore[keep]
+        if reservoir > 0:
+            # Bottom-k random priorities: a uniform sample without replacement
+            sample = np.concatenate( [sample, flat] )
+            priority = np.concatenate( [priority, rng.random_sample(len(flat))] )
+            if len(sample) > reservoir:
+                keep = np.argpartition( priority, reservoir-1 )[0:reservoir]
+                sample, priority = sample[keep], priority[keep]
+    flat = np.unique( np.concatenate( [best, sample] ) )
+    idx = decodeCombinations(flat, radix)
+    ndata = levelFrame( np.column_stack( [levels[j][idx[:,j]] for j in np.arange(len(radix))] ), columns,
+                        [np.sort(x) for x in levels] )
+    ndata['pred'] = intercept + np.sum( [table[j][idx[:,j]] for j in np.arange(len(radix))], axis=0 )
+    if reservoir > 0:
+        ndata['top'] = np.isin( flat, best )
+        ndata = ndata.sort_values(by=['top', 'pred'], ascending=False, kind='stable')
     else:
-        points = np.hstack( [ [0,ndata.shape[0]-1], 
-                             np.random.choice(ndata.shape[0],
-                                              min(ndata.shape[0],random-2),
+        ndata = ndata.sort_values(by='pred', ascending=False)
+    ndata = ndata.reset_index(drop=True)
+    return ndata
+
+def BestDesign(res, dd):
+    """ Exact best combination of an additive model: best level of each factor """
+    levels = []
+    for j in np.arange(dd.shape[1]-1):
+        levels.append( np.asarray( dd.iloc[:,j].unique() ) )
+    columns = dd.columns[0:-1]
+    intercept, table = levelTable(res, columns, levels)
+    best = [ int(np.argmax(x)) for x in table ]
+    ndata = levelFrame( [ [levels[j][best[j]] for j in np.arange(len(levels))] ], columns,
+                        [np.sort(x) for x in levels] )
+    ndata['pred'] = intercept + np.sum( [table[j][best[j]] for j in np.arange(len(levels))] )
+    return ndata
+
+def validationOrder(n, strata=10, rng=None, worst=None):
+    """ Best and worst (default: last) predictions first, then the rest of
+        the ranking visited one random point per stratum at a time
+    """
+    if rng is None:
+        rng = np.random
+    if worst is None:
+        worst = n-1
+    if n < 3:
+        return np.arange(n)
+    rest = np.setdiff1d( np.arange(n), [0, worst] )
+    groups = [ rng.permutation(g) for g in np.array_split( rest, min(strata, len(rest)) ) ]
+    order = [0, worst]
+    for r in np.arange( max([len(g) for g in groups]) ):
+        order.extend( [g[r] for g in groups if r < len(g)] )
+    return np.array(order)
+
+def validationCI(pred, sim, nboot=200, alpha=0.05, rng=None):
+    """ Bootstrap confidence intervals of rms, iqr and the sim ~ pred slope """
+    if rng is None:
+        rng = np.random
+    pred = np.asarray(pred, dtype=float)
+    sim = np.asarray(sim, dtype=float)
+    n = len(sim)
+    idx = rng.randint(n, size=(nboot, n))
+    p, y = pred[idx], sim[idx]
+    d = np.sort( p - y, axis=1 )
+    q = np.round( (n - 1)*np.array([0.25, 0.75]) ).astype(int)
+    pc = p - np.mean(p, axis=1).reshape(-1,1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.sum( pc*y, axis=1 )/np.sum( pc*pc, axis=1 )
+    boot = { 'rms': np.sqrt( np.mean( d*d, axis=1 ) ), 'iqr': d[:,q[1]] - d[:,q[0]], 'slope': slope }
+    return { k: tuple( np.nanpercentile( v, [100*alpha/2, 100*(1-alpha/2)] ) ) for k, v in boot.items() }
+
+def ValidatePred(ndata, par, steps, nplasmids, npromoters, variants, random=100, timespan=3600, show=False,
+                 noise=False, seed=None, executor=None, backend='tellurium', sink=None, run=None,
+                 simcache=None, fast=False, adaptive=False, batch=10, tol=0.5, budget=None, nboot=200,
+                 early=None, rng=None, lib=False):
+    """ Simulate predicted designs: all of them (random=None, too expensive
+        with large sets!), a random sample of random designs or, adaptive,
+        batches until the confidence intervals of rms and iqr (relative) and
+        of the slope (absolute) are narrower than tol or the budget (number
+        of simulations) is spent.
+        rng: random generator (RandomState API), np.random by default.
+        With lib=True the designs are built and simulated here and their
+        models returned in performance['lib']; otherwise they are built in
+        the executor workers, reused from the model store, and there is no 'lib'.
+    """
+    if rng is None:
+        rng = np.random
+    n = ndata.shape[0]
+    nf = list(ndata.columns).index('pred')
+    # Worst prediction: the last row, or the last of the top-k rows
+    # when the table also holds a reservoir sample (see streamCombinations)
+    worst = n-1
+    if 'top' in ndata.columns:
+        worst = int( np.sum( ndata['top'] ) ) - 1
+    if adaptive:
+        order = validationOrder(n, batch, rng, worst)
+        if budget is None:
+            budget = n if random is None else min(random, n)
+    elif random is None:
+        points = np.arange(n)
+    else:
+        points = np.hstack( [ [0,worst], 
+                             rng.choice(n,
+                                              min(n,random-2),
                                               replace=False) ] )
+    if noise and seed is None:
+        seed = rng.randint(2**31)
     library = []
-    results = []
-    for i in points:
-        select = [ int( re.sub('L', '',x)) for x in np.array( ndata.iloc[i,0:-1] )  ]
-        design = Assembly( select, steps, nplasmids, npromoters, variants  )
-        pw = Construct(par,design)
-        library.append(pw)
-        target = SelectCurves(pw)
-        s = pw.simulate(0,timespan,1000)
-        ds = pd.DataFrame(s,columns=s.colnames)
-        results.append( s[target][-1] )
-    ndata.loc[points,'sim'] = results
+    def simulate(points):
+        # Factor levels are integers (see levelFrame): no parsing needed
+        select = np.column_stack( [ np.asarray( ndata.iloc[points, j] ) for j in np.arange(nf) ] )
+        designs = [ Assembly( x, steps, nplasmids, npromoters, variants ) for x in select ]
+        if show or lib:
+            results = []
+            for i, design in zip(points, designs):
+                pw = Construct(par,design,noise=noise,rng=designRng(seed, i))
+                if lib:
+                    library.append(pw)
+                target = SelectCurves(pw)
+                s = pw.simulate(0,timespan,1000)
+                results.append( s[target][-1] )
+        elif sink is not None:
+            results = recordDesigns(sink, run, par, designs, index=points, timespan=timespan, noise=noise, seed=seed,
+                                    executor=executor, backend=backend)
+        else:
+            results = runDesigns(par, designs, index=points, timespan=timespan, noise=noise, seed=seed, executor=executor,
+                                 backend=backend, simcache=simcache, early=early)
+        ndata.loc[points,'sim'] = results
+    ci = None
+    converged = False
+    if adaptive:
+        nsim = 0
+        while nsim < budget and not converged:
+            simulate( order[nsim:min(nsim+batch, budget)] )
+            nsim = min(nsim+batch, budget)
+            done = ndata.loc[ order[0:nsim] ]
+            done = done.loc[ np.logical_not( np.isnan( done['sim'] ) ) ]
+            if done.shape[0] < 5:
+                continue
+            ci = validationCI( done['pred'], done['sim'], nboot, rng=rng )
+            # The slope is dimensionless: its interval width is bounded by tol itself
+            scale = { 'rms': rmse(done['pred'], done['sim']), 'iqr': iqr(done['pred'], done['sim']), 'slope': 1.0 }
+            converged = all( [ (ci[k][1] - ci[k][0]) <= tol*abs(scale[k]) for k in ci ] )
+    else:
+        simulate( points )
+        nsim = len(points)
     ix = np.logical_not( np.isnan( ndata['sim'] ) )
     sim = ndata.loc[ix,'sim']
     pred = ndata.loc[ix,'pred']
     rms = rmse(pred, sim)
     iq = iqr(pred,sim)
     ym = np.mean(sim)
-    ols1 = smf.ols(formula="sim ~ pred", data=ndata )
-    res1 = ols1.fit()
-    performance = { 'rms': rms, 'lib': library, 'ndata': ndata, 'res': res1, 
-                   'iqr': float(iq), 'ym': ym }
+    if fast:
+        res1 = LinearOLS( ndata.loc[ix], 'pred', 'sim' )
+    else:
+        import statsmodels.formula.api as smf
+        ols1 = smf.ols(formula="sim ~ pred", data=ndata )
+        res1 = ols1.fit()
+    performance = { 'rms': rms, 'ndata': ndata, 'res': res1, 
+                   'iqr': float(iq), 'ym': ym, 'nsim': nsim, 'ci': ci, 'converged': converged }
+    if lib:
+        performance['lib'] = library
     return performance
 
 def PlotResponse():
+    import tellurium as te
+    import matplotlib.pyplot as plt
     plt.figure(7)
     te.show()
     fig = plt.gcf()
 #    fig.legend(loc='upper center')
     
 def PlotResults(ndata, out, save=False):
+    import tellurium as te
+    import matplotlib.pyplot as plt
     plt.close('all')
     te.show()
     plt.xlabel('Time [mins]')
@@ -560,35 +1230,68 @@ def PlotResults(ndata, out, save=False):
         plt.savefig(os.path.join(out,'fig2.svg'))
     
 def resetPlot():
+    import tellurium as te
+    import matplotlib.pyplot as plt
     te.show()
     plt.close('all')
     
 def POC(steps=3, nplasmids=2, npromoters=2, variants=1, libsize=32, 
         show=False, visual=False, save=False,
-        predSample=1000, simSample=100, timespan=3600, random=False, out='.'):
+        predSample=1000, simSample=100, timespan=3600, random=False, out='.',
+        noise=False, seed=None, workers=1, executor=None, backend='tellurium', fast=False,
+        replicates=None, sink=None, run=None, simcache=None, doe=None, instrument=None,
+        adaptive=False, tol=0.5, early=None, cache=None, starts=1, doeBudget=None, lib=False):
+    # Build/Test loops run on the executor; a pool is created if none is given
+    # (lib: keep the validated models, see ValidatePred)
+    if instrument is None:
+        instrument = Instrument()
+    if executor is None:
+        with DesignExecutor(workers) as executor:
+            return POC(steps, nplasmids, npromoters, variants, libsize, show, visual, save,
+                       predSample, simSample, timespan, random, out, noise, seed, workers, executor=executor,
+                       backend=backend, fast=fast, replicates=replicates, sink=sink, run=run,
+                       simcache=simcache, doe=doe, instrument=instrument, adaptive=adaptive, tol=tol,
+                       early=early, cache=cache, starts=starts, doeBudget=doeBudget, lib=lib)
+    if sink is not None and run is None:
+        run = time.strftime("%Y-%m-%d-%H-%M-%S")
     # Generate a DoE-based library and simulate results
     if show:
         resetPlot()
     pw, ds, M, results, par, diagnostics = SimulateDesign(steps, nplasmids, npromoters, 
                                                           variants, libsize, show=show, 
-                                                          timespan=timespan, random=random)
+                                                          timespan=timespan, random=random,
+                                                          noise=noise, seed=seed, executor=executor,
+                                                          backend=backend, replicates=replicates,
+                                                          sink=sink, run=run, simcache=simcache, doe=doe,
+                                                          instrument=instrument, early=early, cache=cache,
+                                                          starts=starts, workers=workers, doeBudget=doeBudget)
     if visual:
+        from viscad.viscad import createnewCad, makePDF
         createnewCad(M=M,outfile=os.path.join(out,'doedesign1.svg'),colvariants=True)
         makePDF(os.path.join(out,'doedesign1.svg'),os.path.join(out,'doedesign1.pdf'))
     print('Test')
-    # Fit a regression (constrast) model
-    res, dd = FitModel(M,results)
-    # Predict combinations based on the model
-    ndata = BestCombinations( res, dd, random=predSample )
+    with instrument.phase('Test'):
+        # Fit a regression (constrast) model
+        res, dd = FitModel(M,results,fast=fast)
+        # Predict combinations based on the model
+        ndata = BestCombinations( res, dd, random=predSample )
     print('Learn')
-    # Validate predictions
-    performance = ValidatePred(ndata, par, steps, nplasmids, npromoters, variants, random=simSample, timespan=timespan )
+    with instrument.phase('Learn'):
+        # Validate predictions
+        performance = ValidatePred(ndata, par, steps, nplasmids, npromoters, variants, random=simSample, timespan=timespan, show=show,
+                                   noise=noise, seed=seed, executor=executor, backend=backend,
+                                   sink=sink, run=None if run is None else str(run)+'-validate',
+                                   simcache=simcache, fast=fast, adaptive=adaptive, tol=tol,
+                                   early=early, lib=lib )
+    # Timing and resource metrics (see instrument.METRICS)
+    performance['metrics'] = instrument.report()
     if show:
         PlotResults(ndata, out, save)
 #        PlotResponse()
     return diagnostics, performance
     
-def simInfo(diagnostics, performance, positional=False):
+def simInfo(diagnostics, performance, positional=False, metrics=False):
+    """ Result row of a run; with metrics, the instrument.METRICS columns are appended """
     steps = diagnostics['steps']
     variants = diagnostics['variants']
     npromoters = diagnostics['npromoters']
@@ -621,71 +1324,214 @@ def simInfo(diagnostics, performance, positional=False):
     ipv = res.pvalues['Intercept']
     ppv = res.pvalues['pred']
     row = (steps, variants, npromoters, nplasmids, pos, libsize, J, np.prod(v), pown, rpvn, rsq, rmsd, fpv, ipv, ppv, iqr, ym, seed)
+    if metrics:
+        row = row + tuple( performance['metrics'][x] for x in METRICS )
     return row
 
-def performExperiment(predSample=1000, simSample=100, runs=1000, maxlib=256, out='.', random=False):
-    """ Random test
-    """
-    def variations(var, runs):
-        """ Random sampling of the design space """
-        rows = []
-        for j in np.arange(0,runs):
-            x = []
-            for v in var:
-                x.append( np.random.choice(v) )
-            x[-1] = bool(x[-1])
-            rows.append( x )
-        return rows
-
+def designSpace():
+    """ Ranges of steps, variants, promoters, plasmids and positional sampled in the experiments """
     rsteps = [4,6,8,10]
     rvariants = [1,5,10]
     rpromoters = [1,3,5]
     rplasmids = [1,2]
     rpositional = [False]
+    return [ rsteps, rvariants, rpromoters, rplasmids, rpositional ]
+
+def minLibrary(steps, variants, npromoters, nplasmids):
+    return steps*max(variants-1, 1)*max(nplasmids-1, 1)*max(npromoters-1,1)
+
+def configStream(seed, maxlib=256):
+    """ Deterministic stream of experiment configurations.
+        Yields (cid, [steps, variants, npromoters, nplasmids, positional], libsize, cseed),
+        where cseed seeds the whole POC run of the configuration.
+    """
+    rng = np.random.RandomState(seed)
+    var = designSpace()
+    cid = 0
+    while True:
+        combi = [ v[rng.randint(len(v))] for v in var ]
+        combi[-1] = bool(combi[-1])
+        libsize = max( rng.randint(maxlib), minLibrary(*combi[:-1]) )
+        cseed = rng.randint(2**31)
+        if libsize > maxlib:
+            continue
+        yield cid, combi, libsize, cseed
+        cid += 1
+
+def shardPlan(seed, runs, maxlib=256, shard=0, nshards=1):
+    """ Configurations of one shard: the first runs configurations of the
+        seeded stream are the planned space, shards take them round-robin
+    """
+    for cid, combi, libsize, cseed in configStream(seed, maxlib):
+        if cid >= runs:
+            break
+        if cid % nshards == shard:
+            yield cid, combi, libsize, cseed
+
+def mergeShards(files, outfile=None, runs=None):
+    """ Combine per-shard -resexp.csv outputs sorted by configuration id.
+        The planned number of runs and shards is read from the json plan
+        written next to each output (see performExperiment) unless runs is given.
+        Returns the merged table and the planned configurations missing from it.
+    """
+    plans = []
+    for f in files:
+        sidecar = experimentFiles(f)[0]
+        if os.path.exists(sidecar):
+            with open(sidecar) as h:
+                plans.append( json.load(h) )
+    planned = set( p['runs'] for p in plans if p.get('planned', True) )
+    if runs is None:
+        if len(planned) != 1:
+            raise Exception( 'The planned number of runs is unknown or differs between shards (%s), give runs' % (sorted(planned),) )
+        runs = planned.pop()
+    nshards = set( p['nshards'] for p in plans )
+    if len(nshards) == 1:
+        absent = sorted( set(range(nshards.pop())) - set( p['shard'] for p in plans ) )
+        if len(absent) > 0:
+            print( 'Missing shards: %s' % (absent,) )
+    df = pd.concat( [pd.read_csv(f) for f in files], ignore_index=True )
+    dup = df['cid'].duplicated()
+    if dup.any():
+        print( 'Duplicated configurations: %s' % (sorted(set(df.loc[dup,'cid'])),) )
+        df = df.loc[~dup]
+    df = df.sort_values(by='cid').reset_index(drop=True)
+    missing = sorted( set(range(runs)) - set(df['cid']) )
+    if len(missing) > 0:
+        print( 'Missing configurations: %s' % (missing,) )
+    if outfile is not None:
+        df.to_csv(outfile, index=False)
+    return df, missing
+
+def experimentFiles(outres):
+    """ Sidecar files of a results file: the recorded plan (json) and the failed configurations """
+    base = os.path.splitext(outres)[0]
+    return base+'.json', base+'-failed.csv'
+
+def completedConfigs(outres):
+    """ Configuration ids already in a results file. A partial last line
+        (interrupted write) is truncated so that appending continues cleanly.
+    """
+    if not os.path.exists(outres):
+        return set()
+    with open(outres, 'rb+') as h:
+        data = h.read()
+        if len(data) > 0 and not data.endswith(b'\n'):
+            h.truncate( data.rfind(b'\n') + 1 )
+    df = pd.read_csv(outres)
+    if 'cid' not in df.columns:
+        return set()
+    return set( int(x) for x in df['cid'] )
+
+def failedConfigs(outres):
+    """ Failed configurations of a results file not completed since (latest error per cid) """
+    failed = experimentFiles(outres)[1]
+    if not os.path.exists(failed):
+        return pd.DataFrame( columns=['cid', 'steps', 'variants', 'npromoters', 'nplasmids', 'libsize', 'cseed', 'error'] )
+    df = pd.read_csv(failed)
+    df = df.loc[ np.logical_not( df['cid'].isin( completedConfigs(outres) ) ) ]
+    return df.drop_duplicates(subset='cid', keep='last').reset_index(drop=True)
+
+def performExperiment(predSample=1000, simSample=100, runs=1000, maxlib=256, out='.', random=False,
+                      seed=None, shard=0, nshards=1, metrics=False, hook=None, resume=None, retry=None,
+                      doe=None, cache=None, starts=1, workers=1, doeBudget=None):
+    """ Random test.
+        Configurations come lazily from the seeded stream (configStream); without
+        a seed one is drawn and recorded with the plan in a json sidecar.
+        With a seed, the experiment runs its share of the first runs planned
+        configurations (see shardPlan); otherwise it stops after runs results.
+        Rows carry the configuration id (cid); failed configurations are
+        appended to a -failed.csv sidecar.
+        resume: results file of an interrupted experiment, continued with its
+        recorded plan, skipping completed configurations and, unless listed
+        in retry (a list of cids, empty for all), the failed ones.
+        With metrics, timing and resource columns are added to each row;
+        hook(metrics) is called after every configuration.
+        doe: design function and cache: design cache (see SimulateDesign).
+        starts, doeBudget: optimizer starts and time budget (seconds) of
+        the designs, run on workers processes (also used for the simulations).
+    """
     head = ('steps', 'variants', 'npromoters', 'nplasmids', 'pos', 'libsize', 'eff', 'space', 'pow', 'rpv', 'rsq', 'rmsd', 'fpv', 'ipv', 'ppv', 'iqr', 'ym', 'seed')
-    timestmp = time.strftime("%Y-%m-%d-%H-%M-%S")
-    suffix = '-resexp.csv'
-    if random:
-        suffix = '-rand'+suffix
-    if os.getenv('JOBIDENTIFIER') is not None:
-        outres = os.path.join(out, timestmp+'-'+os.getenv('JOBIDENTIFIER')+suffix)
-    else:        
-        outres = os.path.join(out, timestmp+suffix)
-    var = [ rsteps, rvariants, rpromoters, rplasmids, rpositional ]
-    with open(outres, 'w') as h:
+    if resume is not None:
+        with open( experimentFiles(resume)[0] ) as h:
+            plan = json.load(h)
+        seed, shard, nshards, runs = plan['seed'], plan['shard'], plan['nshards'], plan['runs']
+        maxlib, random, metrics, planned = plan['maxlib'], plan['random'], plan['metrics'], plan['planned']
+        predSample, simSample = plan['predSample'], plan['simSample']
+        outres = resume
+    else:
+        if seed is None and nshards > 1:
+            raise Exception('Sharded experiments require a seed')
+        planned = seed is not None
+        if seed is None:
+            seed = np.random.randint(2**31)
+        timestmp = time.strftime("%Y-%m-%d-%H-%M-%S")
+        suffix = '-resexp.csv'
+        if random:
+            suffix = '-rand'+suffix
+        suffix = '-seed%d-shard%dof%d' % (seed, shard, nshards) + suffix
+        if os.getenv('JOBIDENTIFIER') is not None:
+            outres = os.path.join(out, timestmp+'-'+os.getenv('JOBIDENTIFIER')+suffix)
+        else:
+            outres = os.path.join(out, timestmp+suffix)
+        plan = { 'seed': int(seed), 'shard': shard, 'nshards': nshards, 'runs': runs, 'maxlib': maxlib,
+                 'random': random, 'metrics': metrics, 'planned': planned,
+                 'predSample': predSample, 'simSample': simSample }
+        with open( experimentFiles(outres)[0], 'w' ) as h:
+            json.dump( plan, h, indent=1 )
+    if metrics:
+        head = head + METRICS
+    head = head + ('cid',)
+    done = completedConfigs(outres)
+    failed = failedConfigs(outres)
+    skip = set( int(x) for x in failed['cid'] )
+    if retry is not None:
+        skip -= set(skip) if len(retry) == 0 else set( int(x) for x in retry )
+    skip |= done
+    if planned:
+        configs = shardPlan(seed, runs, maxlib, shard, nshards)
+    else:
+        configs = configStream(seed, maxlib)
+    new = not os.path.exists(outres)
+    failedFile = experimentFiles(outres)[1]
+    newFailed = not os.path.exists(failedFile)
+    nr = len(done)
+    with open(outres, 'a') as h, open(failedFile, 'a') as hf:
         cw = csv.writer(h)
-        cw.writerow( head )
-        fullvar = variations(var, 1000*runs )
-        nr = 1
-        for combi in fullvar:
-            steps, variants, npromoters, nplasmids, positional = combi
-            minlib = steps*max(variants-1, 1)*max(nplasmids-1, 1)*max(npromoters-1,1)
-            libsize = np.random.randint(maxlib)
-            if libsize < minlib:
-                libsize = minlib
-            if libsize > maxlib:
+        cf = csv.writer(hf)
+        if new:
+            cw.writerow( head )
+        if newFailed:
+            cf.writerow( failed.columns )
+        for cid, combi, libsize, cseed in configs:
+            if not planned and nr >= runs:
+                break
+            if not planned and cid >= 1000*runs:
+                raise Exception('Only %d of %d runs succeeded in %d configurations, see %s' % (nr, runs, cid, failedFile))
+            if cid in skip:
                 continue
+            steps, variants, npromoters, nplasmids, positional = combi
             print( "Size=%d Steps=%d Variants=%d Promoters=%d Plasmids=%d" % tuple( [libsize] + combi[:-1] ) )
+            np.random.seed(cseed)
             try:
                 diagnostics, performance = POC(steps=steps, nplasmids=nplasmids, 
                                                npromoters=npromoters, variants=variants, 
                                                libsize=libsize, show=False, visual=False,
                                                predSample=predSample, simSample=simSample,
-                                               random=random)
-                row = simInfo(diagnostics, performance)
+                                               random=random, doe=doe, cache=cache, starts=starts,
+                                               workers=workers, doeBudget=doeBudget, instrument=Instrument(hook))
+                row = simInfo(diagnostics, performance, metrics=metrics) + (cid,)
                 print(row)
                 cw.writerow(row)
                 h.flush()
                 print('Success!')
             except Exception as inst:
-                print(inst.args[0])
-                if inst.args[0].startswith('invalid'):
-                    import pdb
-                    pdb.set_trace()
+                print(inst.args[0] if len(inst.args) > 0 else repr(inst))
+                cf.writerow( (cid, steps, variants, npromoters, nplasmids, libsize, cseed, repr(inst)) )
+                hf.flush()
                 continue
             nr += 1
-            if nr == runs:
-                break
+    return outres
 
 def arguments():
     parser = argparse.ArgumentParser(description='Learning for optimal design. Pablo Carbonell, SYNBIOCHEM, 2019')
@@ -695,10 +1541,47 @@ def arguments():
                         help='Number of runs')
     parser.add_argument('-random', action='store_true',
                         help='Random, non optimal design')
+    parser.add_argument('-seed', type=int, default=None,
+                        help='Seed of the planned configuration stream')
+    parser.add_argument('-shard', type=int, default=0,
+                        help='Shard index (0-based)')
+    parser.add_argument('-nshards', type=int, default=1,
+                        help='Number of shards')
+    parser.add_argument('-merge', nargs='+', default=None,
+                        help='Merge shard result files into -mergeout')
+    parser.add_argument('-mergeout', default=None,
+                        help='Merged results file')
+    parser.add_argument('-metrics', action='store_true',
+                        help='Add timing and resource columns to the results')
+    parser.add_argument('-headless', action='store_true',
+                        help='Batch mode without tellurium and the plotting stack')
+    parser.add_argument('-superset', action='store_true',
+                        help='One compiled model per pathway length')
+    parser.add_argument('-starts', type=int, default=1,
+                        help='Optimizer starts per design (best J is kept)')
+    parser.add_argument('-doeBudget', type=float, default=None,
+                        help='Time budget of the design optimization (seconds)')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Worker processes')
+    parser.add_argument('-resume', default=None,
+                        help='Continue the experiment of this results file')
+    parser.add_argument('-retry', nargs='*', type=int, default=None,
+                        help='With -resume, rerun these failed configurations (all if none given)')
     return parser
 
 if __name__ == "__main__":
     parser = arguments()    
     arg = parser.parse_args()
-    if arg.runs > 0:
-        performExperiment( 1000, 100,runs=arg.runs, maxlib=arg.maxlib, out = os.path.join(os.getenv('DATA'),'doecomp'), random=arg.random )
+    if arg.headless:
+        setHeadless()
+    if arg.superset:
+        setSuperset()
+    if arg.merge is not None:
+        mergeShards( arg.merge, arg.mergeout, runs=arg.runs if arg.runs > 0 else None )
+    elif arg.resume is not None:
+        performExperiment( 1000, 100, resume=arg.resume, retry=arg.retry, starts=arg.starts,
+                           workers=arg.workers, doeBudget=arg.doeBudget )
+    elif arg.runs > 0:
+        performExperiment( 1000, 100,runs=arg.runs, maxlib=arg.maxlib, out = os.path.join(os.getenv('DATA'),'doecomp'), random=arg.random,
+                           seed=arg.seed, shard=arg.shard, nshards=arg.nshards, metrics=arg.metrics,
+                           starts=arg.starts, workers=arg.workers, doeBudget=arg.doeBudget )
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+'''
+pipeline (c) University of Manchester 2019
+
+pipeline is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Streaming Design-Build-Test-Learn experiments on a process pool
+'''
+
+import os, time, csv, json, asyncio, argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import pathSim
+import instrument
+from executor import DesignExecutor, collect
+from surrogate import encodeLevels, levelFrame, RecursiveContrast
+
+
+HEAD = ('steps', 'variants', 'npromoters', 'nplasmids', 'pos', 'libsize', 'eff', 'space', 'pow', 'rpv',
+        'rsq', 'rmsd', 'fpv', 'ipv', 'ppv', 'iqr', 'ym', 'seed', 'cid')
+
+
+def designTask(config, random=False, doe=None, cache=None, starts=1, doeBudget=None):
+    """ Design stage of a configuration (in a worker), as in POC: the
+        parameters, then the DoE library, by default from
+        sampleCompression.evaldes with the design cache (its starts run
+        serially in the worker, the pool is already busy).
+        Returns the parameters, the diagnostics and the random state
+        the rest of the run continues from.
+    """
+    cid, combi, libsize, cseed = config
+    steps, variants, npromoters, nplasmids, positional = combi
+    if cseed is not None:
+        np.random.seed(cseed)
+    par = pathSim.Parameters( nplasmids, npromoters, steps, variants )
+    if doe is None:
+        from sampleCompression import evaldes
+        from cache import designCache
+        doe = partial( evaldes, cache=designCache if cache is None else cache,
+                       starts=starts, workers=1, budget=doeBudget )
+    diagnostics = doe( steps, variants, npromoters, nplasmids, libsize, positional, random=random )
+    return par, diagnostics, np.random.get_state()
+
+def buildTask(par, task, timespan=3600, backend='tellurium', early=None):
+    """ Build and test a batch of designs (in a worker) """
+    index, designs = task
+    if backend == 'ensemble':
+        return pathSim.ensembleTask( par, (index, designs, None), timespan, early=early )
+    return [ pathSim.simulateTask( par, (i, design, None), timespan, early=early )
+             for i, design in zip(index, designs) ]
+
+
+class LibraryRun():
+    """ A configuration in flight: its designs, the results received so far
+        and the contrast model, updated with every batch as it completes.
+        rng continues the random stream of the design task, so a run samples
+        as performExperiment does with the same seed.
+    """
+    def __init__(self, config, par, diagnostics, state):
+        self.cid, self.combi, self.libsize, self.cseed = config
+        steps, variants, npromoters, nplasmids, positional = self.combi
+        self.diagnostics = diagnostics
+        self.par = par
+        self.rng = np.random.RandomState()
+        self.rng.set_state( state )
+        M = diagnostics['M']
+        self.designs = [ pathSim.Assembly( M[i,:], steps, nplasmids, npromoters, variants )
+                         for i in np.arange(M.shape[0]) ]
+        self.results = np.full( len(self.designs), np.nan )
+        self.pending = len(self.designs)
+        self.failed = False
+        columns = ['C'+str(i) for i in np.arange(M.shape[1])]
+        self.dd = levelFrame( encodeLevels(M), columns )
+        self.model = RecursiveContrast( self.dd )
+
+    def batches(self, size):
+        for j in np.arange(0, len(self.designs), size):
+            index = list( np.arange(j, min(j+size, len(self.designs))) )
+            yield index, [ self.designs[i] for i in index ]
+
+    def record(self, index, y):
+        """ Store a completed batch and update the model; True once all are in """
+        self.pending -= len(index)
+        if y is None:
+            self.failed = True
+        elif not self.failed:
+            self.results[index] = y
+            self.model.update( self.dd.iloc[index], y )
+        return self.pending == 0
+
+
+def learnTask(run, executor, predSample=1000, simSample=100, timespan=3600, backend='tellurium',
+              adaptive=False, tol=0.5, early=None):
+    """ Test (rank predictions) and Learn (validate them) of a completed run.
+        Runs in the learn thread, its simulations go to the shared pool.
+    """
+    steps, variants, npromoters, nplasmids, positional = run.combi
+    run.dd['y'] = run.results
+    # The run's own generator: no shared random state between threads
+    ndata = pathSim.BestCombinations( run.model, run.dd, random=predSample, rng=run.rng )
+    performance = pathSim.ValidatePred( ndata, run.par, steps, nplasmids, npromoters, variants,
+                                        random=simSample, timespan=timespan, executor=executor,
+                                        backend=backend, fast=True, adaptive=adaptive, tol=tol,
+                                        early=early, rng=run.rng )
+    return pathSim.simInfo( run.diagnostics, performance ) + (run.cid,)
+
+
+async def streamRuns(plan, writer, workers=None, batch=8, depth=None, queue=None, predSample=1000,
+                     simSample=100, timespan=3600, backend='tellurium', random=False, doe=None,
+                     adaptive=False, tol=0.5, early=None, cache=None, starts=1, doeBudget=None):
+    """ Stage graph over one process pool:
+        design -> build queue -> simulate (workers tasks) -> result queue
+        -> record (model update per batch) -> learn queue -> learn -> writer(row).
+        Queues are bounded and at most depth runs are in flight, so memory
+        stays flat; the pool keeps simulating the next runs while a run is
+        being ranked and validated.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if depth is None:
+        depth = 2 + int(workers/4)
+    if queue is None:
+        queue = 2*workers
+    loop = asyncio.get_running_loop()
+    build = asyncio.Queue( queue )
+    done = asyncio.Queue( queue )
+    learn = asyncio.Queue( depth )
+    inflight = asyncio.Semaphore( depth )
+    stats = { 'runs': 0, 'failed': 0, 'designs': 0 }
+    with ProcessPoolExecutor( workers ) as pool, ThreadPoolExecutor( 1 ) as thread:
+        executor = DesignExecutor( workers, pool=pool )
+
+        async def design():
+            for config in plan:
+                await inflight.acquire()
+                try:
+                    par, diagnostics, state = await loop.run_in_executor( pool, partial(designTask, random=random, doe=doe, cache=cache,
+                                                                             starts=starts, doeBudget=doeBudget), config )
+                    run = LibraryRun( config, par, diagnostics, state )
+                except Exception as inst:
+                    print( 'Design failed (cid=%s): %s' % (config[0], inst) )
+                    stats['failed'] += 1
+                    inflight.release()
+                    continue
+                for task in run.batches( batch ):
+                    await build.put( (run, task) )
+            for w in np.arange(workers):
+                await build.put( None )
+
+        async def simulate():
+            while True:
+                item = await build.get()
+                if item is None:
+                    break
+                run, task = item
+                fn = partial( buildTask, run.par, timespan=timespan, backend=backend, early=early )
+                try:
+                    y, increments = await loop.run_in_executor( pool, partial(collect, fn), task )
+                    instrument.merge( increments )
+                except Exception as inst:
+                    print( 'Build failed (cid=%s): %s' % (run.cid, inst) )
+                    y = None
+                await done.put( (run, task[0], y) )
+
+        async def record():
+            while True:
+                item = await done.get()
+                if item is None:
+                    break
+                run, index, y = item
+                if run.record( index, y ):
+                    await learn.put( run )
+            await learn.put( None )
+
+        async def validate():
+            while True:
+                run = await learn.get()
+                if run is None:
+                    break
+                try:
+                    if run.failed:
+                        raise Exception( 'simulation failed' )
+                    row = await loop.run_in_executor( thread, partial(learnTask, run, executor, predSample,
+                                                                      simSample, timespan, backend, adaptive,
+                                                                      tol, early) )
+                    writer( row )
+                    stats['runs'] += 1
+                    stats['designs'] += len(run.designs)
+                except Exception as inst:
+                    print( 'Learn failed (cid=%s): %s' % (run.cid, inst) )
+                    stats['failed'] += 1
+                finally:
+                    inflight.release()
+
+        async def builders():
+            await asyncio.gather( *[simulate() for w in np.arange(workers)] )
+            await done.put( None )
+
+        await asyncio.gather( design(), builders(), record(), validate() )
+    return stats
+
+def streamExperiment(predSample=1000, simSample=100, runs=1000, maxlib=256, out='.', random=False,
+                     seed=None, shard=0, nshards=1, workers=None, batch=8, depth=None,
+                     backend='tellurium', doe=None, adaptive=False, tol=0.5, early=None, cache=None,
+                     starts=1, doeBudget=None):
+    """ performExperiment as a stream: rows are written as runs complete
+        (cid gives the planned order), with runs overlapping on the pool
+    """
+    if seed is None:
+        seed = np.random.randint(2**31)
+    suffix = '-seed%d-shard%dof%d-stream' % (seed, shard, nshards)
+    if random:
+        suffix += '-rand'
+    outres = os.path.join( out, time.strftime("%Y-%m-%d-%H-%M-%S") + suffix + '-resexp.csv' )
+    # Same json plan as performExperiment, for mergeShards
+    with open( pathSim.experimentFiles(outres)[0], 'w' ) as h:
+        json.dump( { 'seed': int(seed), 'shard': shard, 'nshards': nshards, 'runs': runs, 'maxlib': maxlib,
+                     'random': random, 'metrics': False, 'planned': True,
+                     'predSample': predSample, 'simSample': simSample }, h, indent=1 )
+    plan = pathSim.shardPlan( seed, runs, maxlib, shard, nshards )
+    t0 = time.perf_counter()
+    with open(outres, 'w') as h:
+        cw = csv.writer(h)
+        cw.writerow( HEAD )
+        def writer(row):
+            print(row)
+            cw.writerow(row)
+            h.flush()
+        stats = asyncio.run( streamRuns( plan, writer, workers, batch, depth, predSample=predSample,
+                                         simSample=simSample, backend=backend, random=random, doe=doe,
+                                         adaptive=adaptive, tol=tol, early=early, cache=cache,
+                                         starts=starts, doeBudget=doeBudget ) )
+    stats['seconds'] = time.perf_counter() - t0
+    stats['out'] = outres
+    print( "Runs=%d Failed=%d Designs=%d Time=%.1fs" % (stats['runs'], stats['failed'], stats['designs'], stats['seconds']) )
+    return stats
+
+def arguments():
+    parser = argparse.ArgumentParser(description='Streaming DBTL experiments on a process pool')
+    parser.add_argument('-runs', type=int, default=10,
+                        help='Number of planned configurations')
+    parser.add_argument('-maxlib', type=int, default=256,
+                        help='Maximum library size')
+    parser.add_argument('-random', action='store_true',
+                        help='Random, non optimal design')
+    parser.add_argument('-seed', type=int, default=None,
+                        help='Seed of the planned configuration stream')
+    parser.add_argument('-shard', type=int, default=0,
+                        help='Shard index (0-based)')
+    parser.add_argument('-nshards', type=int, default=1,
+                        help='Number of shards')
+    parser.add_argument('-workers', type=int, default=None,
+                        help='Worker processes (default: all cores)')
+    parser.add_argument('-batch', type=int, default=8,
+                        help='Designs per simulation task')
+    parser.add_argument('-depth', type=int, default=None,
+                        help='Configurations in flight')
+    parser.add_argument('-backend', default='tellurium', choices=['tellurium', 'ensemble'],
+                        help='Simulation backend')
+    parser.add_argument('-out', default='.',
+                        help='Output folder')
+    return parser
+
+if __name__ == '__main__':
+    arg = arguments().parse_args()
+    pathSim.setHeadless()
+    streamExperiment( 1000, 100, arg.runs, arg.maxlib, arg.out, arg.random, arg.seed, arg.shard, arg.nshards,
+                      arg.workers, arg.batch, arg.depth, arg.backend )
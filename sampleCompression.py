@@ -11,16 +11,100 @@ To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
 
 from doebase.doebase import doeTemplate, promoterList, plasmidList, read_excel
 from doebase import OptDes
-import os
+import os, time
 import numpy as np
 from itertools import product
 import csv
+from cache import designCache
 
 
 
 
 def evaldes( steps, variants, npromoters, nplasmids, libsize, positional, 
-             outfile=None, random=False ):
+             outfile=None, random=False, cache=designCache, starts=1, workers=1, budget=None ):
+    """ Optimal design of the library. Designs are looked up first in
+        the design cache by their arguments and optimizer settings.
+        With starts > 1, independent starts run on workers processes and
+        the best J is kept (see multistart); with a budget (seconds) the
+        best design found by then is returned, and it is not cached.
+    """
+    seed = np.random.randint(10000)
+    RMSE = 10
+    alpha = 0.05
+    args = ( steps, variants, npromoters, nplasmids, libsize, positional, outfile, random )
+    def optimize():
+        if starts > 1 or budget is not None:
+            return multistart( args, seed, starts, RMSE, alpha, workers, budget )
+        return optdes( *args, seed=seed, starts=1, RMSE=RMSE, alpha=alpha )
+    if outfile is not None or cache is None or budget is not None:
+        return optimize()
+    return cache.design( optimize, steps=int(steps), variants=int(variants), npromoters=int(npromoters),
+                         nplasmids=int(nplasmids), libsize=int(libsize), positional=bool(positional),
+                         random=bool(random), seed=int(seed), starts=int(starts), RMSE=RMSE, alpha=alpha )
+
+def startSeeds(seed, starts):
+    """ Distinct seeds of the starts, the first one is the seed itself """
+    rng = np.random.RandomState(seed)
+    seeds = [int(seed)]
+    while len(seeds) < starts:
+        s = int( rng.randint(2**31) )
+        if s not in seeds:
+            seeds.append( s )
+    return seeds
+
+def multistart( args, seed, starts=4, RMSE=10, alpha=0.05, workers=1, budget=None ):
+    """ Independent single starts of the optimizer with distinct seeds.
+        Returns the diagnostics of the best J, with the seed and J of every
+        start (nan if it failed or was not finished within budget seconds).
+    """
+    from multiprocessing import Pool
+    from queue import Queue, Empty
+    seeds = startSeeds(seed, starts)
+    J = np.full( starts, np.nan )
+    best = None
+    t0 = time.time()
+    def keep(k, diagnostics):
+        nonlocal best
+        J[k] = diagnostics['J']
+        if best is None or J[k] > best['J']:
+            best = diagnostics
+    if workers is None or workers > 1:
+        pool = Pool( workers )
+        finished = Queue()
+        try:
+            for k, s in enumerate(seeds):
+                pool.apply_async( optdes, args, dict(seed=s, starts=1, RMSE=RMSE, alpha=alpha),
+                                  callback=lambda d, k=k: finished.put( (k, d) ),
+                                  error_callback=lambda e, k=k: finished.put( (k, None) ) )
+            for n in np.arange(starts):
+                timeout = None if budget is None else max( 0, budget - (time.time() - t0) )
+                try:
+                    k, diagnostics = finished.get( timeout=timeout )
+                except Empty:
+                    break
+                if diagnostics is not None:
+                    keep( k, diagnostics )
+        finally:
+            # Starts still running at the budget are killed with their workers
+            pool.terminate()
+            pool.join()
+    else:
+        for k, s in enumerate(seeds):
+            if budget is not None and time.time() - t0 > budget and best is not None:
+                break
+            try:
+                keep( k, optdes( *args, seed=s, starts=1, RMSE=RMSE, alpha=alpha ) )
+            except Exception:
+                pass
+    if best is None:
+        raise Exception("No solution")
+    best['seeds'] = seeds
+    best['Jstarts'] = J
+    best['starts'] = int( np.sum( np.isfinite(J) ) )
+    return best
+
+def optdes( steps, variants, npromoters, nplasmids, libsize, positional,
+            outfile=None, random=False, seed=None, starts=1, RMSE=10, alpha=0.05 ):
 
     plasmids = plasmidList(nplasmids)
     promoters = promoterList(npromoters)
@@ -42,16 +126,13 @@ def evaldes( steps, variants, npromoters, nplasmids, libsize, positional,
     else:
         fact, partinfo = read_excel( None, doedf=doe )
     try:
-        seed = np.random.randint(10000)
-        starts = 1
-        RMSE = 10
-        alpha = 0.05
         factors, fnames, diagnostics = OptDes.makeDoeOptDes(fact, size=libsize, 
                                                             seed=seed, starts=starts,
                                                             RMSE= RMSE, alpha=alpha,
                                                             random=random )
     except:
         raise Exception("No solution")
+    diagnostics.setdefault( 'seed', seed )
     diagnostics['steps'] = steps
     diagnostics['variants'] = variants
     diagnostics['npromoters'] = npromoters
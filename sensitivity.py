@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+'''
+sensitivity (c) University of Manchester 2019
+
+sensitivity is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Global sensitivity analysis of the pathway parameters
+'''
+
+import os, json, hashlib, argparse
+import numpy as np
+import pandas as pd
+from functools import partial
+import pathSim
+from ensemble import KINETICS
+from executor import DesignExecutor
+
+
+class SensitivityProblem():
+    """ Factors of a pathway of a given promoter pattern: the copy number,
+        the strength of each promoter and every kinetic constant of ranges()
+        with a non-empty range, all log-uniform as in instance().
+        Constants with a fixed range keep their value.
+    """
+    def __init__(self, nsteps, own=None, copy_number=(1.0, 1e2), expression=(1e-8, 1e-7), decay=1e-4):
+        n = nsteps
+        if own is None:
+            own = [True]*n
+        self.n = n
+        # Only the promoter pattern matters to the model structure
+        self.promoters = [ 1.0 if own[i] or i == 0 else None for i in np.arange(n) ]
+        self.groups = pathSim.promoterGroups( self.promoters )
+        self.upstream = decay
+        self.names = []
+        self.bounds = []
+        self.columns = []
+        self.base = np.zeros( (2+len(KINETICS))*n )
+        self.add( 'Copy_number', copy_number, np.arange(n) )
+        for i in np.unique(self.groups):
+            self.add( 'm%d_Expression_k1' % (i+1,), expression,
+                      n + np.array( [j for j in np.arange(n) if self.groups[j] == i] ) )
+        par = pathSim.ranges()
+        for k, x in enumerate(KINETICS):
+            group, name = x.split('_')
+            low, high = par[group][name]
+            for i in np.arange(n):
+                col = (2+k)*n + i
+                if high > low:
+                    self.add( 'm%d_%s' % (i+1, x), (low, high), [col] )
+                else:
+                    self.base[col] = low
+        self.k = len(self.names)
+
+    def add(self, name, bounds, columns):
+        self.names.append( name )
+        self.bounds.append( np.log(bounds) )
+        self.columns.append( np.asarray(columns) )
+
+    def values(self, U):
+        """ Design vectors (see pathSim.designVector) of unit samples U (N, k) """
+        U = np.atleast_2d(U)
+        V = np.tile( self.base, (U.shape[0], 1) )
+        for j, (low, high) in enumerate(self.bounds):
+            x = np.exp( low + U[:,j]*(high - low) )
+            V[:, self.columns[j]] = x.reshape(-1,1)
+        return V
+
+
+def sobolSample(problem, N=1024, seed=0):
+    """ Saltelli design: A, B and the k matrices A with column j from B.
+        Returns the unit samples, (N*(k+2), k) in blocks [A; B; AB_1; ...; AB_k].
+    """
+    from scipy.stats import qmc
+    k = problem.k
+    X = qmc.Sobol( 2*k, scramble=True, seed=seed ).random( N )
+    A, B = X[:,0:k], X[:,k:]
+    blocks = [A, B]
+    for j in np.arange(k):
+        AB = A.copy()
+        AB[:,j] = B[:,j]
+        blocks.append( AB )
+    return np.vstack( blocks )
+
+def sobolIndices(y, N, k, nboot=200, alpha=0.05, seed=None):
+    """ First-order (Saltelli 2010) and total (Jansen) indices with
+        bootstrap confidence intervals, from the outputs of sobolSample
+    """
+    y = np.asarray(y, dtype=float).reshape( (k+2, N) )
+    fA, fB, fAB = y[0], y[1], y[2:]
+    def indices(rows):
+        a, b, ab = fA[rows], fB[rows], fAB[:,rows]
+        var = np.var( np.concatenate([a, b]) )
+        s1 = np.mean( b*(ab - a), axis=1 )/var
+        st = 0.5*np.mean( np.power(a - ab, 2), axis=1 )/var
+        return s1, st
+    s1, st = indices( np.arange(N) )
+    rng = np.random.default_rng(seed)
+    boot = [ indices( rng.integers(0, N, N) ) for b in np.arange(nboot) ]
+    q = [100*alpha/2, 100*(1-alpha/2)]
+    s1ci = np.percentile( [x[0] for x in boot], q, axis=0 )
+    stci = np.percentile( [x[1] for x in boot], q, axis=0 )
+    return pd.DataFrame( { 'S1': s1, 'S1_low': s1ci[0], 'S1_high': s1ci[1],
+                           'ST': st, 'ST_low': stci[0], 'ST_high': stci[1] } )
+
+def morrisSample(problem, r=20, levels=4, seed=0):
+    """ r one-at-a-time trajectories on a grid of levels.
+        Returns the unit samples (r*(k+1), k) and the signed steps of each trajectory (r, k).
+    """
+    rng = np.random.default_rng(seed)
+    k = problem.k
+    delta = levels/(2.0*(levels - 1))
+    grid = np.arange(levels)/(levels - 1.0)
+    grid = grid[ grid <= 1 - delta + 1e-12 ]
+    U = np.empty( (r*(k+1), k) )
+    steps = np.zeros( (r, k) )
+    for t in np.arange(r):
+        x = rng.choice( grid, size=k )
+        U[t*(k+1)] = x
+        for s, j in enumerate( rng.permutation(k) ):
+            step = delta if x[j] + delta <= 1 + 1e-12 else -delta
+            x = x.copy()
+            x[j] += step
+            steps[t,j] = step
+            U[t*(k+1)+s+1] = x
+    return U, steps
+
+def morrisIndices(U, y, steps, nboot=200, alpha=0.05, seed=None):
+    """ Mean, mean absolute (mu*) and standard deviation of the elementary
+        effects, with a bootstrap confidence interval of mu* over trajectories
+    """
+    r, k = steps.shape
+    y = np.asarray(y, dtype=float).reshape( (r, k+1) )
+    U = U.reshape( (r, k+1, k) )
+    ee = np.zeros( (r, k) )
+    for t in np.arange(r):
+        changed = np.argmax( np.abs( np.diff(U[t], axis=0) ), axis=1 )
+        ee[t, changed] = np.diff( y[t] )/steps[t, changed]
+    rng = np.random.default_rng(seed)
+    boot = [ np.mean( np.abs( ee[rng.integers(0, r, r)] ), axis=0 ) for b in np.arange(nboot) ]
+    ci = np.percentile( boot, [100*alpha/2, 100*(1-alpha/2)], axis=0 )
+    return pd.DataFrame( { 'mu': np.mean(ee, axis=0), 'mu_star': np.mean(np.abs(ee), axis=0),
+                           'mu_star_low': ci[0], 'mu_star_high': ci[1],
+                           'sigma': np.std(ee, axis=0, ddof=1) if r > 1 else np.zeros(k) } )
+
+def evaluateTask(problem, task, timespan=3600, backend='ensemble'):
+    """ Endpoints of a block of design vectors. The ensemble backend integrates
+        the block at once (RoadRunner if it fails); otherwise all vectors run
+        on one compiled model of the problem structure.
+    """
+    start, V = task
+    if backend == 'ensemble':
+        try:
+            ens = pathSim.vectorEnsemble( V, [problem.groups]*V.shape[0], problem.upstream )
+            return ens.endpoint(timespan)
+        except Exception:
+            pass
+    pw = pathSim.pathway( problem.promoters, private=False )
+    plan = pathSim.designPlan( pw, problem.promoters )
+    y = np.empty( V.shape[0] )
+    for j in np.arange(V.shape[0]):
+        plan.apply( pw, V[j] )
+        y[j] = pathSim.Endpoint( pw, timespan )
+    return y
+
+def setup(problem, U, timespan, backend, meta=None):
+    """ Description of an evaluation: the problem, the samples (by content),
+        the simulation settings and meta (e.g. method, N, seed)
+    """
+    U = np.ascontiguousarray(U, dtype=np.float64)
+    desc = { 'names': problem.names, 'bounds': [list(b) for b in problem.bounds],
+             'base': list(problem.base), 'promoters': problem.promoters, 'upstream': problem.upstream,
+             'samples': list(U.shape), 'U': hashlib.sha1( U.tobytes() ).hexdigest(),
+             'timespan': timespan, 'backend': backend, 'meta': meta }
+    return json.loads( json.dumps( desc, default=float ) )
+
+def evaluate(problem, U, out=None, executor=None, backend='ensemble', batch=512, timespan=3600, block=None,
+             meta=None):
+    """ Endpoints of the unit samples U, in blocks of batch samples per task.
+        With out, results are appended to that raw float64 file after every
+        round of tasks, and a rerun resumes after the samples already stored.
+        The setup is recorded in out.json and a rerun with a different
+        problem, samples or settings is refused.
+    """
+    if executor is None:
+        executor = DesignExecutor(1)
+    if block is None:
+        block = 4*max(1, executor.workers)*batch
+    done = []
+    start = 0
+    if out is not None:
+        desc = setup( problem, U, timespan, backend, meta )
+        sidecar = out + '.json'
+        if os.path.exists(out):
+            recorded = None
+            if os.path.exists(sidecar):
+                with open(sidecar) as h:
+                    recorded = json.load(h)
+            if recorded != desc:
+                raise Exception( 'Cannot resume %s: it was computed with a different setup' % (out,) )
+            done = [ np.fromfile(out, dtype=np.float64) ]
+            start = len(done[0])
+        else:
+            with open(sidecar, 'w') as h:
+                json.dump( desc, h )
+    fn = partial( evaluateTask, problem, timespan=timespan, backend=backend )
+    for b in np.arange(start, U.shape[0], block):
+        V = problem.values( U[b:b+block] )
+        tasks = [ (b+j, V[j:j+batch]) for j in np.arange(0, V.shape[0], batch) ]
+        y = np.concatenate( executor.map(fn, tasks) )
+        if out is not None:
+            with open(out, 'ab') as h:
+                y.astype(np.float64).tofile(h)
+        done.append( y )
+    if len(done) == 0:
+        return np.zeros(0)
+    return np.concatenate( done )[0:U.shape[0]]
+
+def analyze(nsteps=4, method='sobol', N=1024, r=50, out=None, workers=1, backend='ensemble',
+            batch=512, timespan=3600, log=True, seed=0, nboot=200):
+    """ Sensitivity of the final product of a nsteps pathway (log10 if log) """
+    problem = SensitivityProblem( nsteps )
+    if method == 'sobol':
+        U = sobolSample( problem, N, seed )
+    else:
+        U, steps = morrisSample( problem, r, seed=seed )
+    with DesignExecutor(workers) as executor:
+        y = evaluate( problem, U, out, executor, backend, batch, timespan,
+                      meta={ 'method': method, 'N': N, 'r': r, 'seed': seed } )
+    if log:
+        y = np.log10( np.maximum(y, 1e-30) )
+    if method == 'sobol':
+        table = sobolIndices( y, N, problem.k, nboot, seed=seed )
+    else:
+        table = morrisIndices( U, y, steps, nboot, seed=seed )
+    table.insert( 0, 'factor', problem.names )
+    return table
+
+def arguments():
+    parser = argparse.ArgumentParser(description='Global sensitivity analysis of the pathway parameters')
+    parser.add_argument('-steps', type=int, default=4,
+                        help='Pathway steps')
+    parser.add_argument('-method', default='sobol', choices=['sobol', 'morris'],
+                        help='Sobol indices or Morris screening')
+    parser.add_argument('-N', type=int, default=1024,
+                        help='Base samples (Sobol), a power of 2')
+    parser.add_argument('-r', type=int, default=50,
+                        help='Trajectories (Morris)')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Worker processes')
+    parser.add_argument('-backend', default='ensemble', choices=['ensemble', 'tellurium'],
+                        help='Simulation backend')
+    parser.add_argument('-batch', type=int, default=512,
+                        help='Samples per task')
+    parser.add_argument('-out', default=None,
+                        help='Raw output file of the endpoints (resumable)')
+    parser.add_argument('-table', default=None,
+                        help='Output file of the indices (csv)')
+    parser.add_argument('-seed', type=int, default=0,
+                        help='Sampling seed')
+    return parser
+
+if __name__ == '__main__':
+    arg = arguments().parse_args()
+    pathSim.setHeadless()
+    table = analyze( arg.steps, arg.method, arg.N, arg.r, arg.out, arg.workers, arg.backend,
+                     arg.batch, seed=arg.seed )
+    print( table.to_string(index=False) )
+    if arg.table is not None:
+        table.to_csv( arg.table, index=False )
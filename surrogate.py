@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+'''
+surrogate (c) University of Manchester 2019
+
+surrogate is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Additive level (contrast) models fitted by direct least squares
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def encodeLevels(M, caps=None):
+    """ Factor level of each design entry. Promoter positions (columns 3, 5, ...)
+        are capped: levels above half the observed ones are merged into one
+        (or above caps[j], e.g. the levels of a model fitted before).
+    """
+    codes = np.array(M, dtype=int, copy=True)
+    for j in np.arange(3, codes.shape[1], 2):
+        if caps is None:
+            plevel = int( len(np.unique(codes[:,j]))/2 )
+        else:
+            plevel = caps[j]
+        codes[:,j] = np.minimum( codes[:,j], plevel )
+    return codes
+
+def levelFrame(codes, columns, categories=None):
+    """ Design levels as integer Categoricals, one level table per factor
+        (by default the sorted observed levels, as in the regression table)
+    """
+    codes = np.asarray(codes)
+    if categories is None:
+        categories = [ np.unique(codes[:,j]) for j in np.arange(codes.shape[1]) ]
+    return pd.DataFrame( { c: pd.Categorical( codes[:,j], categories=categories[j] )
+                           for j, c in enumerate(columns) }, columns=columns )
+
+def levelLabels(codes):
+    """ Level labels for display """
+    return np.char.add( 'L', np.asarray(codes).astype(str) )
+
+def labelFrame(data):
+    """ Copy of a design table with the factor levels shown as labels """
+    data = data.copy()
+    for x in data.columns:
+        if hasattr(data[x], 'cat'):
+            data[x] = levelLabels( np.asarray(data[x]) )
+    return data
+
+def rmse(x1, x2):
+    """ Root mean squared error (as statsmodels.tools.eval_measures) """
+    return np.sqrt( np.mean( np.power( np.asanyarray(x1) - np.asanyarray(x2), 2 ) ) )
+
+def iqr(x1, x2):
+    """ Interquartile range of the error (as statsmodels.tools.eval_measures) """
+    xdiff = np.sort( np.asarray(x1) - np.asarray(x2) )
+    idx = np.round( (len(xdiff) - 1)*np.array([0.25, 0.75]) ).astype(int)
+    return xdiff[idx[1]] - xdiff[idx[0]]
+
+def levelTable(res, factors, levels):
+    """ Intercept and contribution of each level of each factor to the
+        prediction of an additive contrast model (reference levels add 0)
+    """
+    table = []
+    for x, lev in zip(factors, levels):
+        table.append( np.array( [res.params.get('%s[T.%s]' % (x, l), 0.0) for l in lev] ) )
+    return res.params['Intercept'], table
+
+
+class ContrastOLS():
+    """ OLS fit of y on treatment-coded factors, with the same coefficients
+        and diagnostics as smf.ols('y ~ C0 + C1 + ...'). As in patsy, the
+        reference of each factor is its first category (Categorical columns)
+        or its first level in sorted order.
+    """
+    def __init__(self, dd, target='y'):
+        self.factors = [x for x in dd.columns if x != target]
+        self.levels = []
+        for x in self.factors:
+            if hasattr(dd[x], 'cat'):
+                self.levels.append( np.asarray(dd[x].cat.categories) )
+            else:
+                self.levels.append( np.unique( np.asarray(dd[x]) ) )
+        X = self.exog( dd )
+        y = np.asarray( dd[target], dtype=float )
+        self.fit( X, y )
+
+    def names(self):
+        names = ['Intercept']
+        for x, lev in zip(self.factors, self.levels):
+            names.extend( ['%s[T.%s]' % (x, l) for l in lev[1:]] )
+        return names
+
+    def codes(self, data, j):
+        """ Level index of each row for factor j """
+        col = data[ self.factors[j] ]
+        lev = self.levels[j]
+        if hasattr(col, 'cat') and np.array_equal( np.asarray(col.cat.categories), lev ):
+            codes = np.asarray( col.cat.codes )
+            if np.any( codes < 0 ):
+                raise Exception( 'Unknown level of %s' % (self.factors[j],) )
+            return codes
+        values = np.asarray(col)
+        codes = np.minimum( np.searchsorted( lev, values ), len(lev)-1 )
+        if np.any( lev[codes] != values ):
+            raise Exception( 'Unknown level of %s' % (self.factors[j],) )
+        return codes
+
+    def exog(self, data):
+        """ One-hot design matrix (intercept + non-reference levels) """
+        blocks = [ np.ones( (data.shape[0], 1) ) ]
+        for j, lev in enumerate(self.levels):
+            codes = self.codes( data, j )
+            blocks.append( (codes.reshape(-1,1) == np.arange(1, len(lev)).reshape(1,-1)).astype(float) )
+        return np.hstack( blocks )
+
+    def fit(self, X, y):
+        beta, ssr, rank, sv = np.linalg.lstsq( X, y, rcond=None )
+        self.nobs = X.shape[0]
+        self.rank = rank
+        self.fittedvalues = X.dot(beta)
+        self.resid = y - self.fittedvalues
+        pinv = np.linalg.pinv(X)
+        self.summarize( beta, float( np.dot(self.resid, self.resid) ),
+                        float( np.sum( np.power(y - np.mean(y), 2) ) ), np.dot(pinv, pinv.T) )
+
+    def summarize(self, beta, ssr, centered_tss, xtxinv):
+        """ Coefficients and diagnostics from the fitted quantities """
+        from scipy import stats
+        names = self.names()
+        self.df_model = np.float64( self.rank - 1 )
+        self.df_resid = np.float64( self.nobs - self.rank )
+        self.params = pd.Series( beta, index=names )
+        self.ssr = ssr
+        self.centered_tss = centered_tss
+        self.ess = self.centered_tss - self.ssr
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.rsquared = 1 - self.ssr/self.centered_tss
+            self.rsquared_adj = 1 - (self.nobs - 1)/self.df_resid*(1 - self.rsquared)
+            self.scale = self.ssr/self.df_resid
+            cov = self.scale*xtxinv
+            self.bse = pd.Series( np.sqrt(np.diag(cov)), index=names )
+            self.tvalues = self.params/self.bse
+            self.pvalues = pd.Series( 2*stats.t.sf( np.abs(self.tvalues), self.df_resid ), index=names )
+            self.fvalue = (self.ess/self.df_model)/self.scale
+            self.f_pvalue = stats.f.sf( self.fvalue, self.df_model, self.df_resid )
+
+    def predict(self, data):
+        return pd.Series( self.exog(data).dot( self.params.values ), index=data.index )
+
+
+class LinearOLS(ContrastOLS):
+    """ OLS fit of target on one numeric regressor, as smf.ols('target ~ x') """
+    def __init__(self, dd, x, target):
+        self.factors = [x]
+        X = self.exog( dd )
+        y = np.asarray( dd[target], dtype=float )
+        self.fit( X, y )
+
+    def names(self):
+        return ['Intercept', self.factors[0]]
+
+    def exog(self, data):
+        return np.column_stack( [np.ones(data.shape[0]), np.asarray(data[self.factors[0]], dtype=float)] )
+
+
+class RecursiveContrast(ContrastOLS):
+    """ Contrast model updated as batches of (design levels, result) arrive.
+        Keeps the Gram matrix X'X, X'y and the y moments (rank-k update per
+        batch), so an update costs O(k*p^2 + p^3) whatever the number of
+        designs seen. Coefficients and diagnostics match a batch refit
+        (minimum-norm solution while the design is rank deficient).
+        The factor levels are fixed by the first table, which may come
+        without the target column (levels of a library not simulated yet).
+    """
+    def __init__(self, dd, target='y'):
+        self.factors = [x for x in dd.columns if x != target]
+        self.levels = []
+        for x in self.factors:
+            if hasattr(dd[x], 'cat'):
+                self.levels.append( np.asarray(dd[x].cat.categories) )
+            else:
+                self.levels.append( np.unique( np.asarray(dd[x]) ) )
+        p = len( self.names() )
+        self.xtx = np.zeros( (p, p) )
+        self.xty = np.zeros( p )
+        self.nobs = 0
+        # y is accumulated around the first batch mean (only the intercept moves)
+        self.shift = None
+        self.ysum = 0.0
+        self.yty = 0.0
+        if target in dd.columns:
+            self.update( dd[self.factors], dd[target] )
+
+    def update(self, data, y):
+        """ Add a batch: data holds the factor levels, y the results """
+        X = self.exog( data )
+        y = np.asarray( y, dtype=float )
+        if self.shift is None:
+            self.shift = float( np.mean(y) )
+        y = y - self.shift
+        self.xtx += np.dot( X.T, X )
+        self.xty += np.dot( X.T, y )
+        self.ysum += float( np.sum(y) )
+        self.yty += float( np.dot(y, y) )
+        self.nobs += X.shape[0]
+        self.solve()
+        return self
+
+    def solve(self):
+        from scipy.linalg import cho_factor, cho_solve, LinAlgError
+        p = len(self.xty)
+        try:
+            factor = cho_factor( self.xtx )
+            beta = cho_solve( factor, self.xty )
+            xtxinv = cho_solve( factor, np.eye(p) )
+            self.rank = p
+        except LinAlgError:
+            # Rank deficient: minimum-norm solution, with a cutoff above
+            # the rounding noise of the Gram eigenvalues
+            w, V = np.linalg.eigh( self.xtx )
+            keep = w > 1e-10*np.max(w)
+            xtxinv = np.dot( V[:,keep]/w[keep], V[:,keep].T )
+            beta = np.dot( xtxinv, self.xty )
+            self.rank = int( np.sum(keep) )
+        ssr = max( self.yty - 2*np.dot(beta, self.xty) + np.dot(beta, np.dot(self.xtx, beta)), 0.0 )
+        centered_tss = self.yty - self.ysum**2/self.nobs
+        # Add back the shift: the minimum-norm fit of a constant
+        beta = beta + self.shift*np.dot( xtxinv, self.xtx[:,0] )
+        self.summarize( beta, float(ssr), float(centered_tss), xtxinv )
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+'''
+conftest (c) University of Manchester 2019
+
+conftest is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Shared fixtures: headless models and an offline doebase
+'''
+
+import os, sys, types
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def fakeDoebase(calls):
+    """ Stand-in for doebase: the template is passed through and the
+        optimizer is the offline design of benchmark.localDoe
+    """
+    import benchmark
+    doebase = types.ModuleType('doebase')
+    template = types.ModuleType('doebase.doebase')
+    optdes = types.ModuleType('doebase.OptDes')
+    template.plasmidList = lambda n: n
+    template.promoterList = lambda n: n
+    template.doeTemplate = lambda tree, plasmids, promoters, genes, positional: (
+        len(tree), len(genes[tree[0]]), promoters, plasmids, positional )
+    template.read_excel = lambda outfile, doedf=None: (doedf, None)
+    def makeDoeOptDes(fact, size, seed, starts, RMSE, alpha, random):
+        calls.append( seed )
+        steps, variants, npromoters, nplasmids, positional = fact
+        diagnostics = benchmark.localDoe( steps, variants, npromoters, nplasmids, size, positional, seed=seed )
+        return diagnostics['factors'], None, diagnostics
+    optdes.makeDoeOptDes = makeDoeOptDes
+    doebase.doebase = template
+    doebase.OptDes = optdes
+    return { 'doebase': doebase, 'doebase.doebase': template, 'doebase.OptDes': optdes }
+
+
+@pytest.fixture
+def headless(monkeypatch):
+    """ Headless models for the test only """
+    import cache
+    monkeypatch.setenv( 'PATHSIM_HEADLESS', '1' )
+    monkeypatch.setattr( cache, 'HEADLESS', True )
+
+@pytest.fixture
+def doebase(monkeypatch):
+    """ The fake doebase in sys.modules; returns the list of optimizer seeds.
+        sampleCompression is imported against it and dropped afterwards.
+    """
+    calls = []
+    for name, module in fakeDoebase(calls).items():
+        monkeypatch.setitem( sys.modules, name, module )
+    previous = sys.modules.pop( 'sampleCompression', None )
+    yield calls
+    sys.modules.pop( 'sampleCompression', None )
+    if previous is not None:
+        sys.modules['sampleCompression'] = previous
+
+@pytest.fixture
+def designLibrary(headless):
+    """ Parameters and 16 designs of a 4 step pathway """
+    import pathSim, benchmark
+    state = np.random.get_state()
+    np.random.seed(1)
+    par = pathSim.Parameters( 2, 3, 4, 3 )
+    np.random.set_state( state )
+    M = benchmark.localDoe( 4, 3, 3, 2, 16, False, seed=2 )['M']
+    designs = [ pathSim.Assembly( M[i,:], 4, 2, 3, 3 ) for i in np.arange(M.shape[0]) ]
+    return par, designs
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_design (c) University of Manchester 2019
+
+test_design is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Compiled design plans and memoized simulations
+'''
+
+import numpy as np
+
+
+def namedConstruct(par, design, promoters):
+    """ A design set up one name at a time, as Construct did before the plans """
+    import pathSim
+    pw = pathSim.pathway( promoters, store=None )
+    nsteps = len(par['Step'])
+    pathSim.initModel( pw, nsteps=nsteps, substrate=1.0*1e-3 )
+    for i in np.arange(nsteps):
+        pw['m'+str(i+1)+'_Copy_number'] = float(par['Copy_number'][design[0]])
+        j = i
+        while promoters[j] is None and j > 0:
+            j -= 1
+        pw['m'+str(i+1)+'_Expression_k1'] = promoters[j]
+        enzyme = par['Step'][i][design[2+i*2]]
+        for val in enzyme:
+            pw['m{}_{}'.format(i+1, val)] = enzyme[val][0]
+    return pw
+
+
+def test_design_plan_matches_named_writes(designLibrary):
+    import pathSim
+    par, designs = designLibrary
+    for design in designs:
+        pw = pathSim.Construct( par, design )
+        ref = namedConstruct( par, design, pathSim.Promoters(par, design) )
+        assert np.allclose( pw.model.getGlobalParameterValues(), ref.model.getGlobalParameterValues(), rtol=1e-12 )
+        assert np.array_equal( pw.model.getFloatingSpeciesConcentrations(),
+                               ref.model.getFloatingSpeciesConcentrations() )
+        assert np.isclose( pathSim.Endpoint(pw), pathSim.Endpoint(ref), rtol=1e-9, atol=0 )
+
+def test_memoized_simulations_match_uncached(designLibrary, tmp_path):
+    import pathSim
+    from cache import SimCache
+    par, designs = designLibrary
+    plain = pathSim.runDesigns( par, designs, noise=True, seed=5 )
+    simcache = SimCache( path=str(tmp_path / 'sims'), version='test' )
+    first = pathSim.runDesigns( par, designs, noise=True, seed=5, simcache=simcache )
+    assert simcache.stats['misses'] == len(designs)
+    again = pathSim.runDesigns( par, designs, noise=True, seed=5, simcache=simcache )
+    assert simcache.stats['hits'] == len(designs)
+    # A new cache on the same directory reads the disk tier
+    disk = SimCache( path=str(tmp_path / 'sims'), version='test' )
+    stored = pathSim.runDesigns( par, designs, noise=True, seed=5, simcache=disk )
+    assert disk.stats['disk'] == len(designs)
+    assert plain == first == again == stored
+    # Another noise seed is another simulation
+    other = pathSim.runDesigns( par, designs, noise=True, seed=6, simcache=simcache )
+    assert simcache.stats['misses'] == 2*len(designs)
+    assert other != plain
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_designcache (c) University of Manchester 2019
+
+test_designcache is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: A repeated experiment takes its designs from the design cache
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def test_repeated_experiment_hits_design_cache(tmp_path, headless, doebase):
+    import pathSim
+    from cache import DesignCache
+    calls = doebase
+    cache = DesignCache( str(tmp_path / 'designs') )
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    out1 = pathSim.performExperiment( 50, 10, runs=2, maxlib=48, out=str(first), seed=11, cache=cache )
+    optimized = len(calls)
+    assert optimized > 0
+    assert cache.stats['hits'] == 0
+    out2 = pathSim.performExperiment( 50, 10, runs=2, maxlib=48, out=str(second), seed=11, cache=cache )
+    # Same configurations and seeds: no optimization, every design from the cache
+    assert len(calls) == optimized
+    assert cache.stats['hits'] == cache.stats['misses'] == optimized
+    r1, r2 = pd.read_csv(out1), pd.read_csv(out2)
+    assert list(r1['cid']) == list(r2['cid'])
+    assert np.allclose( r1['eff'], r2['eff'] )
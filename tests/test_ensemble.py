@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_ensemble (c) University of Manchester 2019
+
+test_ensemble is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Vectorized ensemble against finite differences and RoadRunner
+'''
+
+import numpy as np
+
+
+def tightEndpoint(pw, timespan=3600):
+    import pathSim
+    pw.integrator.relative_tolerance = 1e-10
+    pw.integrator.absolute_tolerance = 1e-18
+    return pathSim.Endpoint( pw, timespan )
+
+
+def test_jacobian_matches_finite_differences():
+    import ensemble
+    ens = ensemble.randomEnsemble( 4, 3 )
+    y = ens.simulate( 600, points=5 )[1][:,-1,:].ravel()
+    J = ens.jacobian( 0, y ).toarray()
+    h = 1e-7*np.maximum( np.abs(y), 1e-12 )
+    I = np.eye( len(y) )
+    F = np.column_stack( [ (ens.rates(0, y+h[k]*I[k]) - ens.rates(0, y-h[k]*I[k]))/(2*h[k])
+                           for k in np.arange(len(y)) ] )
+    assert np.allclose( J, F, rtol=1e-5, atol=1e-8*np.max(np.abs(F)) )
+    # Every nonzero derivative is in the sparsity pattern
+    assert np.all( ens.sparsity().toarray()[ F != 0 ] )
+
+def test_ensemble_endpoints_match_roadrunner(designLibrary):
+    import pathSim
+    par, designs = designLibrary
+    rr = np.array( [ tightEndpoint( pathSim.Construct(par, design) ) for design in designs ] )
+    ens = pathSim.Ensemble( par, designs ).endpoint( 3600, rtol=1e-10, atol=1e-18 )
+    assert np.allclose( ens, rr, rtol=1e-6, atol=0 )
+
+def test_early_endpoints_match_full_integration(designLibrary):
+    import pathSim
+    par, designs = designLibrary
+    full = np.array( [ pathSim.Endpoint( pathSim.Construct(par, design) ) for design in designs ] )
+    early = np.array( [ pathSim.EarlyEndpoint( pathSim.Construct(par, design), 3600, 1e-3 )[0]
+                        for design in designs ] )
+    assert np.allclose( early, full, rtol=5e-3, atol=0 )
+    ens, stops = pathSim.Ensemble( par, designs ).endpoint( 3600, early=1e-3 )
+    assert np.allclose( ens, full, rtol=5e-3, atol=0 )
+    assert np.all( stops <= 3600 )
+
+def test_superset_model_matches_per_topology_models(designLibrary, monkeypatch):
+    import pathSim
+    par, designs = designLibrary
+    topology = np.array( [ tightEndpoint( pathSim.Construct(par, design) ) for design in designs ] )
+    monkeypatch.setattr( pathSim, 'SUPERSET', True )
+    superset = np.array( [ tightEndpoint( pathSim.Construct(par, design) ) for design in designs ] )
+    assert np.allclose( superset, topology, rtol=1e-6, atol=0 )
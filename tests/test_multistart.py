@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_multistart (c) University of Manchester 2019
+
+test_multistart is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Parallel optimizer starts stop at the time budget
+'''
+
+import time
+import numpy as np
+
+
+def slowOptdes(quick, seed=None, starts=1, RMSE=10, alpha=0.05):
+    """ Optimizer stand-in: only the start with the quick seed finishes """
+    if seed != quick:
+        time.sleep( 60 )
+    return { 'J': float(seed), 'seed': seed }
+
+
+def test_budget_terminates_running_starts(doebase, monkeypatch):
+    import sampleCompression
+    monkeypatch.setattr( sampleCompression, 'optdes', slowOptdes )
+    quick = sampleCompression.startSeeds( 5, 4 )[1]
+    budget = 2
+    t0 = time.time()
+    best = sampleCompression.multistart( (quick,), 5, starts=4, workers=2, budget=budget )
+    elapsed = time.time() - t0
+    assert elapsed < budget + 2
+    assert best['seed'] == quick
+    assert best['starts'] == 1
+    assert np.sum( np.isfinite(best['Jstarts']) ) == 1
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_ranking (c) University of Manchester 2019
+
+test_ranking is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Streaming top-k search against the full library ranking
+'''
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def model():
+    import pathSim, benchmark
+    M = benchmark.localDoe( 4, 3, 2, 3, 48, False, seed=4 )['M']
+    y = np.random.RandomState(3).rand( M.shape[0] )
+    return pathSim.FitModel( M, y, fast=True )
+
+def levelRows(ndata):
+    nf = list(ndata.columns).index('pred')
+    return [ tuple(x) for x in np.asarray( ndata.iloc[:,0:nf] ).astype(int) ]
+
+
+def test_streaming_top_k_matches_full_ranking(model):
+    import pathSim
+    res, dd = model
+    full = pathSim.BestCombinations( res, dd, random=None )
+    top = pathSim.BestCombinations( res, dd, random=None, top=10, chunk=37 )
+    assert top.shape[0] == 10
+    assert levelRows(top) == levelRows(full)[0:10]
+    assert np.allclose( top['pred'], full['pred'][0:10] )
+    best = pathSim.BestDesign( res, dd )
+    assert levelRows(best) == levelRows(full)[0:1]
+
+def test_reservoir_sample_is_kept_apart_from_top_k(model):
+    import pathSim
+    res, dd = model
+    full = pathSim.BestCombinations( res, dd, random=None )
+    ndata = pathSim.BestCombinations( res, dd, random=None, top=10, reservoir=20, chunk=37,
+                                      rng=np.random.RandomState(0) )
+    assert list(ndata['top']) == [True]*10 + [False]*(ndata.shape[0]-10)
+    assert levelRows(ndata)[0:10] == levelRows(full)[0:10]
+    # The sample rows are library designs with their predictions
+    ranked = dict( zip( levelRows(full), full['pred'] ) )
+    assert 20 <= ndata.shape[0] <= 30
+    assert np.allclose( ndata['pred'], [ ranked[x] for x in levelRows(ndata) ] )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+'''
+test_surrogate (c) University of Manchester 2019
+
+test_surrogate is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Contrast models against the batch and statsmodels fits
+'''
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def library():
+    import benchmark
+    diagnostics = benchmark.localDoe( 4, 3, 2, 3, 48, False, seed=4 )
+    M = diagnostics['M']
+    y = np.random.RandomState(3).rand( M.shape[0] )
+    return M, y
+
+
+def test_incremental_fit_matches_batch_from_small_first_batch(library):
+    import pathSim
+    M, y = library
+    res, dd = pathSim.FitModel( M[:8], y[:8], incremental=True, library=M )
+    for j in np.arange(8, M.shape[0], 10):
+        pathSim.UpdateModel( res, M[j:j+10], y[j:j+10] )
+    batch, bd = pathSim.FitModel( M, y, fast=True )
+    assert res.nobs == M.shape[0]
+    assert np.allclose( np.asarray(res.params), np.asarray(batch.params), atol=1e-10 )
+    assert np.isclose( res.rsquared, batch.rsquared )
+    assert np.allclose( res.predict(bd), batch.predict(bd) )
+    sm, dd = pathSim.FitModel( M, y )
+    assert np.allclose( np.asarray(res.params), np.asarray(sm.params) )
+    assert np.allclose( np.asarray(res.bse), np.asarray(sm.bse) )
+    assert np.isclose( res.fvalue, sm.fvalue )
+
+def test_contrast_fits_match_statsmodels(library):
+    import pathSim
+    import statsmodels.formula.api as smf
+    from surrogate import LinearOLS
+    M, y = library
+    sm, dd = pathSim.FitModel( M, y )
+    fast, fd = pathSim.FitModel( M, y, fast=True )
+    assert list(fast.params.index) == list(sm.params.index)
+    for x in ('params', 'bse', 'pvalues'):
+        assert np.allclose( getattr(fast, x), getattr(sm, x) )
+    for x in ('rsquared', 'rsquared_adj', 'fvalue', 'df_resid'):
+        assert np.isclose( getattr(fast, x), getattr(sm, x) )
+    assert np.allclose( fast.predict(fd), sm.predict(dd) )
+    dd['pred'] = sm.predict(dd) + 0.1*y
+    line = LinearOLS( dd, 'pred', 'y' )
+    ref = smf.ols( formula='y ~ pred', data=dd ).fit()
+    assert np.allclose( line.params, ref.params )
+    assert np.allclose( line.bse, ref.bse )
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+'''
+trajectories (c) University of Manchester 2019
+
+trajectories is licensed under the MIT License.
+
+To view a copy of this license, visit <http://opensource.org/licenses/MIT/>.
+
+@author:  Pablo Carbonell
+@description: Chunked columnar store of simulated trajectories and endpoints
+'''
+
+import os, csv, uuid
+import numpy as np
+import pandas as pd
+
+
+class TrajectoryStore():
+    """ Append-only store of design simulations in a local directory.
+        - Each flushed batch is an Arrow IPC file (one record batch):
+          run, design, endpoint, time and one list column per species.
+        - index.csv maps (run, design) to its chunk and row, with the endpoint.
+        Reading a design memory-maps its chunk only; with compression=None
+        the returned arrays are zero-copy views of the file.
+        Several processes may write to the same store: chunk names are unique
+        per chunk and the index is appended under a lock (fcntl).
+    """
+    def __init__(self, path, batch=64, compression='zstd'):
+        import pyarrow
+        self.pa = pyarrow
+        self.path = path
+        self.batch = batch
+        self.compression = compression
+        self.buffer = []
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self.indexFile = os.path.join(path, 'index.csv')
+        self.nchunks = len( [x for x in os.listdir(path) if x.endswith('.arrow')] )
+
+    def append(self, run, design, species, time, values, endpoint):
+        """ Trajectory of a design: values is (time points x species) """
+        self.buffer.append( (str(run), int(design), list(species), np.asarray(time, dtype=float),
+                             np.asarray(values, dtype=float), float(endpoint)) )
+        if len(self.buffer) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered designs; species sets may differ between runs """
+        groups = {}
+        for x in self.buffer:
+            groups.setdefault( tuple(x[2]), [] ).append( x )
+        for species, rows in groups.items():
+            self.writeChunk( species, rows )
+        self.buffer = []
+
+    def writeChunk(self, species, rows):
+        pa = self.pa
+        name = 'chunk-%06d-%s.arrow' % (self.nchunks, uuid.uuid4().hex[0:12])
+        self.nchunks += 1
+        def listColumn(arrays):
+            offsets = np.concatenate( [[0], np.cumsum([len(a) for a in arrays])] ).astype(np.int32)
+            return pa.ListArray.from_arrays( pa.array(offsets), pa.array(np.concatenate(arrays)) )
+        columns = {
+            'run': pa.array( [x[0] for x in rows] ),
+            'design': pa.array( [x[1] for x in rows], type=pa.int64() ),
+            'endpoint': pa.array( [x[5] for x in rows], type=pa.float64() ),
+            'time': listColumn( [x[3] for x in rows] ),
+            }
+        for j, s in enumerate(species):
+            columns[s] = listColumn( [x[4][:,j] for x in rows] )
+        rb = pa.RecordBatch.from_pydict( columns )
+        options = pa.ipc.IpcWriteOptions( compression=self.compression )
+        tmp = os.path.join(self.path, name+'.tmp')
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, rb.schema, options=options) as writer:
+                writer.write_batch(rb)
+        os.replace( tmp, os.path.join(self.path, name) )
+        # The index is only updated once the chunk is complete
+        import fcntl
+        with open(self.indexFile+'.lock', 'a') as lock:
+            fcntl.flock( lock, fcntl.LOCK_EX )
+            try:
+                with open(self.indexFile, 'a') as h:
+                    cw = csv.writer(h)
+                    if h.tell() == 0:
+                        cw.writerow( ('run', 'design', 'chunk', 'row', 'endpoint') )
+                    for i, x in enumerate(rows):
+                        cw.writerow( (x[0], x[1], name, i, x[5]) )
+            finally:
+                fcntl.flock( lock, fcntl.LOCK_UN )
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def index(self):
+        if not os.path.exists(self.indexFile):
+            return pd.DataFrame( columns=['run', 'design', 'chunk', 'row', 'endpoint'] )
+        return pd.read_csv( self.indexFile, dtype={'run': str} )
+
+    def endpoints(self, run=None):
+        ix = self.index()
+        if run is not None:
+            ix = ix.loc[ ix['run'] == str(run) ]
+        return ix[['run', 'design', 'endpoint']].reset_index(drop=True)
+
+    def read(self, run, design):
+        """ Time and species trajectories of a design as a dict of arrays """
+        pa = self.pa
+        ix = self.index()
+        hit = ix.loc[ (ix['run'] == str(run)) & (ix['design'] == int(design)) ]
+        if hit.shape[0] == 0:
+            raise KeyError( (run, design) )
+        chunk, row = hit.iloc[-1]['chunk'], int(hit.iloc[-1]['row'])
+        source = pa.memory_map( os.path.join(self.path, chunk), 'r' )
+        rb = pa.ipc.open_file( source ).get_batch(0)
+        out = {}
+        for name in rb.schema.names:
+            if name in ('run', 'design', 'endpoint'):
+                continue
+            col = rb.column(name)
+            start, stop = col.offsets[row].as_py(), col.offsets[row+1].as_py()
+            out[name] = col.values.slice(start, stop-start).to_numpy( zero_copy_only=True )
+        return out